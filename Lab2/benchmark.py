@@ -0,0 +1,285 @@
+import argparse
+import json
+import os
+import random
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, List, Tuple
+
+STRUCT_FORMAT = "!cIHIHI"
+# outer header + inner header + send timestamp
+MIN_SIZE = 17 + 9 + 8
+# seconds the sink keeps listening after the generator stops
+GRACE = 1.0
+# drops that mean the emulator couldn't keep up, as opposed to the routes' configured loss
+CAPACITY_DROPS = ("queue_full", "aqm", "policed")
+
+Address = Tuple[str, int]
+
+
+def table_destinations(filename: str, host: str, port: int) -> List[Address]:
+    """Returns the destinations the forwarding table lists for one emulator."""
+    destinations: List[Address] = []
+    with open(filename, "r") as f:
+        for line in f:
+            line = line.split()
+            if len(line) >= 8 and line[0] == host and int(line[1]) == port:
+                destinations.append((socket.gethostbyname(line[2]), int(line[3])))
+    return destinations
+
+
+def parse_mix(mix: str) -> Dict[int, float]:
+    """Parses a priority mix like "1:0.2,2:0.3,3:0.5"."""
+    weights = {}
+    for part in mix.split(","):
+        priority, weight = part.split(":")
+        weights[int(priority)] = float(weight)
+    return weights
+
+
+class LoadGenerator:
+    """Sends DATA packets in the emulator's header format at a fixed rate.
+
+    Every packet carries its send time, so that the sink can measure latency.
+
+    """
+
+    def __init__(self, emulator: Address, destinations: List[Address], rate: float, duration: float,
+                 size: int, mix: Dict[int, float], seed: int = 0) -> None:
+        assert size >= MIN_SIZE, f"Packets must be at least {MIN_SIZE} bytes"
+        self.emulator = emulator
+        self.destinations = destinations
+        self.rate = rate
+        self.duration = duration
+        self.size = size
+        self.mix = mix
+        self.rng = random.Random(seed)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((socket.gethostbyname(socket.gethostname()), 0))
+        self.sent = 0
+
+    def templates(self) -> List[bytearray]:
+        """One prebuilt packet per (destination, priority) pair, weighted by the mix."""
+        src_addr = int.from_bytes(socket.inet_aton(self.sock.getsockname()[0]), byteorder='big')
+        src_port = self.sock.getsockname()[1]
+        packets = []
+        for dest_addr, dest_port in self.destinations:
+            for priority, weight in self.mix.items():
+                packet = bytearray(self.size)
+                struct.pack_into(STRUCT_FORMAT, packet, 0, str(priority).encode(), src_addr, src_port,
+                                 int.from_bytes(socket.inet_aton(dest_addr), byteorder='big'), dest_port,
+                                 self.size - 17)
+                struct.pack_into("!cII", packet, 17, b"D", 0, self.size - 26)
+                packets.append((packet, weight))
+        return self.rng.choices([p for p, _ in packets], [w for _, w in packets], k=1024)
+
+    def run(self) -> None:
+        packets = self.templates()
+        start = time.time()
+        total = int(self.rate * self.duration)
+        for i in range(total):
+            # keep to the schedule instead of sleeping a fixed gap, so send time doesn't add up
+            wait = start + i / self.rate - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            packet = packets[i % len(packets)]
+            struct.pack_into("!I", packet, 18, i)
+            struct.pack_into("!d", packet, 26, time.time())
+            self.sock.sendto(packet, self.emulator)
+            self.sent += 1
+
+
+class Sink:
+    """Receives the generator's packets on every destination it can bind and measures them."""
+
+    def __init__(self, destinations: List[Address]) -> None:
+        self.socks = []
+        # the destinations actually bound, the only ones worth sending to from this host
+        self.addresses: List[Address] = []
+        for address in destinations:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                sock.bind(address)
+            except OSError:
+                # the destination lives on another host
+                continue
+            sock.settimeout(0.1)
+            self.socks.append(sock)
+            self.addresses.append(address)
+        assert self.socks, "None of the destinations can be bound on this host"
+        self.latencies: List[float] = []
+        self.first = None
+        self.last = None
+        self.running = True
+
+    def receive(self, sock: socket.socket) -> None:
+        while self.running:
+            try:
+                packet = sock.recv(65536)
+            except socket.timeout:
+                continue
+            now = time.time()
+            if len(packet) >= MIN_SIZE:
+                self.latencies.append((now - struct.unpack_from("!d", packet, 26)[0]) * 1000)
+                self.first = self.first or now
+                self.last = now
+
+    def start(self) -> List[threading.Thread]:
+        threads = [threading.Thread(target=self.receive, args=(s,), daemon=True) for s in self.socks]
+        for t in threads:
+            t.start()
+        return threads
+
+    def stop(self, threads: List[threading.Thread]) -> None:
+        self.running = False
+        for t in threads:
+            t.join()
+        for s in self.socks:
+            s.close()
+
+    def report(self) -> Dict[str, float]:
+        received = len(self.latencies)
+        latencies = sorted(self.latencies)
+
+        def percentile(p: float) -> float:
+            return latencies[min(int(p / 100 * received), received - 1)] if received else float("nan")
+
+        span = (self.last - self.first) if received > 1 else 0
+        return {
+            "received": received,
+            "pps": received / span if span else float(received),
+            "p50": percentile(50),
+            "p99": percentile(99),
+        }
+
+
+def control_stats(port: int) -> Dict[str, int]:
+    """Asks an emulator's control socket (--control) for its drop counters."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(1)
+    try:
+        sock.sendto(json.dumps({"cmd": "stats"}).encode(), ("127.0.0.1", port))
+        return json.loads(sock.recv(65536))["stats"]
+    except (OSError, ValueError):
+        return {}
+    finally:
+        sock.close()
+
+
+def measure(emulator: Address, destinations: List[Address], rate: float, duration: float, size: int,
+            mix: Dict[int, float], seed: int, control: int) -> Dict:
+    """Runs the generator against a sink once and returns what arrived and why the rest didn't."""
+    sink = Sink(destinations)
+    threads = sink.start()
+    before = control_stats(control)
+    generator = LoadGenerator(emulator, sink.addresses, rate, duration, size, mix, seed)
+    generator.run()
+    time.sleep(GRACE)
+    sink.stop(threads)
+    after = control_stats(control)
+    result = sink.report()
+    result["sent"] = generator.sent
+    # without the emulator's counters the drops can't be told apart
+    result["counted"] = bool(after)
+    result["drops"] = {k: after[k] - before.get(k, 0) for k in after
+                       if k != "forwarded" and after[k] != before.get(k, 0)}
+    return result
+
+
+def sweep(args) -> None:
+    """Finds the highest forwarding rate for every queue size and packet size."""
+    host = socket.gethostname()
+    emulator = (socket.gethostbyname(host), args.e)
+    destinations = table_destinations(args.f, host, args.e)
+    assert destinations, f"No entry for {host}:{args.e} in {args.f}"
+    mix = parse_mix(args.mix)
+    here = os.path.dirname(os.path.abspath(__file__))
+    best: Dict[Tuple[int, int], float] = {}
+
+    print(f"{'queue':>6}{'size':>7}{'offered':>9}{'sent':>8}{'pps':>10}{'loss':>8}{'cap':>8}{'p50 ms':>9}{'p99 ms':>9}  drops")
+    for queue_size in args.queues:
+        emulator_proc = subprocess.Popen(
+            [sys.executable, os.path.join(here, "emulator.py"), "-p", str(args.e), "-q", str(queue_size),
+             "-f", os.path.abspath(args.f), "-l", args.log, "--control", str(args.control)] + args.emulator_args)
+        time.sleep(1)
+        try:
+            for size in args.sizes:
+                for rate in args.rates:
+                    r = measure(emulator, destinations, rate, args.duration, size, mix, args.seed, args.control)
+                    loss = 1 - r["received"] / r["sent"] if r["sent"] else 0
+                    # only drops for lack of capacity count against the rate, not the routes' own loss
+                    capacity = sum(r["drops"].get(k, 0) for k in CAPACITY_DROPS) / r["sent"] if r["sent"] else 0
+                    if not r["counted"]:
+                        capacity = loss
+                    print(f"{queue_size:>6}{size:>7}{rate:>9}{r['sent']:>8}{r['pps']:>10.1f}{loss:>8.2%}{capacity:>8.2%}"
+                          f"{r['p50']:>9.2f}{r['p99']:>9.2f}  "
+                          + ", ".join(f"{k}-{v}" for k, v in sorted(r["drops"].items())))
+                    if capacity <= args.max_loss:
+                        best[(queue_size, size)] = max(best.get((queue_size, size), 0), r["pps"])
+        finally:
+            emulator_proc.terminate()
+            emulator_proc.wait()
+
+    print()
+    print(f"Max forwarding rate with at most {args.max_loss:.1%} of packets dropped for capacity (packets/s)")
+    print(f"{'queue':>6}" + "".join(f"{size:>10}" for size in args.sizes))
+    for queue_size in args.queues:
+        print(f"{queue_size:>6}" + "".join(f"{best.get((queue_size, size), 0):>10.1f}" for size in args.sizes))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Emulator throughput benchmark")
+    sub = parser.add_subparsers(dest="mode", required=True)
+
+    gen = sub.add_parser("gen", help="send load to an emulator")
+    gen.add_argument("-f", help="the forwarding table", type=str, required=True)
+    gen.add_argument("-a", help="the host name of the emulator", type=str, required=True)
+    gen.add_argument("-e", help="the port of the emulator", type=int, required=True)
+    gen.add_argument("-r", help="packets per second", type=float, required=True)
+    gen.add_argument("-d", help="duration in seconds", type=float, default=5)
+    gen.add_argument("-s", help="packet size in bytes", type=int, default=1024)
+    gen.add_argument("--mix", help="priority mix, e.g. 1:0.2,2:0.3,3:0.5", type=str, default="1:1")
+    gen.add_argument("--seed", type=int, default=0)
+
+    sink = sub.add_parser("sink", help="receive load and report rate and latency")
+    sink.add_argument("-f", help="the forwarding table", type=str, required=True)
+    sink.add_argument("-a", help="the host name of the emulator", type=str, required=True)
+    sink.add_argument("-e", help="the port of the emulator", type=int, required=True)
+    sink.add_argument("-d", help="how long to listen in seconds", type=float, default=10)
+
+    run = sub.add_parser("run", help="start emulators and sweep rate, packet size and queue size")
+    run.add_argument("-f", help="the forwarding table, with entries for this host", type=str, required=True)
+    run.add_argument("-e", help="the port of the emulator", type=int, required=True)
+    run.add_argument("--log", help="the emulator log file", type=str, default="benchmark.log")
+    run.add_argument("--control", help="the emulator's control port", type=int, default=9999)
+    run.add_argument("--queues", type=int, nargs="+", default=[10, 100, 1000])
+    run.add_argument("--sizes", type=int, nargs="+", default=[64, 512, 1400, 8000])
+    run.add_argument("--rates", type=float, nargs="+", default=[1000, 5000, 10000, 20000, 50000])
+    run.add_argument("--duration", type=float, default=3)
+    run.add_argument("--mix", type=str, default="1:1")
+    run.add_argument("--max-loss", help="queue, AQM and policer drops still counted as forwarding at full rate", type=float, default=0.01)
+    run.add_argument("--seed", type=int, default=0)
+    run.add_argument("--emulator-args", help="extra emulator options, e.g. \"--ring --aqm codel\"",
+                     type=lambda s: s.split(), default=[])
+
+    args = parser.parse_args()
+    if args.mode == "gen":
+        destinations = table_destinations(args.f, args.a, args.e)
+        g = LoadGenerator((socket.gethostbyname(args.a), args.e), destinations, args.r, args.d, args.s,
+                          parse_mix(args.mix), args.seed)
+        g.run()
+        print(f"Sent {g.sent} packets")
+    elif args.mode == "sink":
+        s = Sink(table_destinations(args.f, args.a, args.e))
+        threads = s.start()
+        time.sleep(args.d)
+        s.stop(threads)
+        r = s.report()
+        print(f"Received {r['received']} packets, {r['pps']:.1f} packets/s, "
+              f"latency p50 {r['p50']:.2f} ms, p99 {r['p99']:.2f} ms")
+    else:
+        sweep(args)
@@ -0,0 +1,96 @@
+import struct
+import threading
+from collections import deque
+from time import sleep, time
+from typing import Union
+
+# pcapng link type for packets that start with an IPv4 header
+LINKTYPE_RAW = 101
+# records waiting for the writer before new ones are dropped
+CAPTURE_BUFFER = 65536
+# seconds the writer sleeps when there is nothing to write
+WRITER_IDLE = 0.05
+
+
+def pad4(data: bytes) -> bytes:
+    return data + b"\0" * (-len(data) % 4)
+
+
+def ip_checksum(header: bytes) -> int:
+    total = sum(struct.unpack("!10H", header))
+    while total > 0xFFFF:
+        total = (total & 0xFFFF) + (total >> 16)
+    return ~total & 0xFFFF
+
+
+def udp_datagram(packet: bytes) -> bytes:
+    """Wraps an emulator packet in IPv4 and UDP headers built from its own header,
+    so that packet analyzers show the flow the packet belongs to."""
+    src_addr, src_port, dest_addr, dest_port = struct.unpack_from("!IHIH", packet, 1)
+    udp = struct.pack("!HHHH", src_port, dest_port, 8 + len(packet), 0)
+    ip = struct.pack("!BBHHHBBHII", 0x45, 0, 20 + len(udp) + len(packet), 0, 0, 64, 17, 0,
+                     src_addr, dest_addr)
+    ip = ip[:10] + struct.pack("!H", ip_checksum(ip)) + ip[12:]
+    return ip + udp + packet
+
+
+def section_header() -> bytes:
+    body = struct.pack("<IHHq", 0x1A2B3C4D, 1, 0, -1)
+    return struct.pack("<II", 0x0A0D0D0A, 12 + len(body)) + body + struct.pack("<I", 12 + len(body))
+
+
+def interface_description() -> bytes:
+    body = struct.pack("<HHI", LINKTYPE_RAW, 0, 0)
+    return struct.pack("<II", 1, 12 + len(body)) + body + struct.pack("<I", 12 + len(body))
+
+
+def enhanced_packet(timestamp: float, data: bytes, comment: str) -> bytes:
+    """An Enhanced Packet Block with a microsecond timestamp and a comment option."""
+    micros = int(timestamp * 1000000)
+    text = comment.encode()
+    options = struct.pack("<HH", 1, len(text)) + pad4(text) + struct.pack("<HH", 0, 0)
+    body = struct.pack("<IIIII", 0, micros >> 32, micros & 0xFFFFFFFF, len(data), len(data)) + \
+        pad4(data) + options
+    return struct.pack("<II", 6, 12 + len(body)) + body + struct.pack("<I", 12 + len(body))
+
+
+class PacketCapture:
+    """Captures emulator packets to a pcapng file.
+
+    The forwarding path only appends (timestamp, annotation, packet) to a bounded
+    buffer; a background thread builds the pcapng blocks and writes them, so capture
+    doesn't change forwarding timing. When the buffer is full new records are counted
+    in `missed` and skipped.
+
+    """
+
+    def __init__(self, filename: str, buffer_size: int = CAPTURE_BUFFER) -> None:
+        self.filename = filename
+        self.buffer_size = buffer_size
+        self.records = deque()
+        self.missed = 0
+        self.running = True
+        self.file = open(filename, "wb")
+        self.file.write(section_header() + interface_description())
+        self.writer = threading.Thread(target=self.write_records, daemon=True)
+        self.writer.start()
+
+    def record(self, annotation: str, packet: Union[bytes, memoryview], timestamp: Union[float, None] = None) -> None:
+        if len(self.records) >= self.buffer_size:
+            self.missed += 1
+            return
+        self.records.append((timestamp or time(), annotation, bytes(packet)))
+
+    def write_records(self) -> None:
+        while self.running or self.records:
+            if not self.records:
+                self.file.flush()
+                sleep(WRITER_IDLE)
+                continue
+            timestamp, annotation, packet = self.records.popleft()
+            self.file.write(enhanced_packet(timestamp, udp_datagram(packet), annotation))
+        self.file.close()
+
+    def close(self) -> None:
+        self.running = False
+        self.writer.join()
@@ -1,75 +1,581 @@
 import socket
 import argparse
+import json
 import struct
-from typing import List, Tuple, Union
-from collections import deque
+from typing import DefaultDict, Dict, List, Tuple, Union
+from collections import defaultdict, deque
+from array import array
 from time import time
 import logging
+import multiprocessing
 import random
+import selectors
+import signal
+from capture import PacketCapture
+from loss import BernoulliLoss, GilbertElliottLoss, LossModel, TraceLoss, read_loss_trace, stream_seed
 
 Address = Tuple[str, int]
-Table_Entry = Tuple[Tuple, Tuple, int, int]
+Table_Entry = Tuple[Tuple, Tuple, int, int, Union["TokenBucket", None], Union[LossModel, None]]
 Queue_Entry = Tuple[bytes, float, Table_Entry]
 STRUCT_FORMAT = "!cIHIHI"
+# largest datagram the emulator reads from its socket
+MAX_PACKET = 8192
+# most packets read from the socket before the emulator releases due packets again
+MAX_BATCH = 256
+# seconds between statistics reports from worker processes
+STATS_INTERVAL = 5
+# burst size used when a forwarding entry gives a bandwidth but no burst
+DEFAULT_BURST = 8192
+# seconds between checks of the control socket
+CONTROL_INTERVAL = 0.1
+# number of power-of-two millisecond buckets in the sojourn time histograms
+HIST_BUCKETS = 16
+
+
+def merge_stats(all_stats) -> Dict[str, int]:
+    """Sums the counters reported by several workers."""
+    merged: DefaultDict[str, int] = defaultdict(int)
+    for stats in all_stats:
+        for k, v in stats.items():
+            merged[k] += v
+    return dict(merged)
+
+
+def route_key(address: Address) -> bytes:
+    """Packs an (ip, port) address the way it appears in the packet header."""
+    return socket.inet_aton(address[0]) + address[1].to_bytes(2, byteorder='big')
+
+
+class TokenBucket:
+    """Shapes a link to `rate` bytes per second, allowing bursts of up to `burst` bytes."""
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time()
+
+    def consume(self, size: int) -> bool:
+        """Takes `size` bytes worth of tokens if the packet may be sent now."""
+        now = time()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        # a packet larger than the burst goes out on a full bucket and leaves it in debt
+        if self.tokens >= min(size, self.burst):
+            self.tokens -= size
+            return True
+        return False
+
+    def ready_at(self, size: int) -> float:
+        """When (time() in seconds) the bucket will hold enough tokens for a packet of `size` bytes."""
+        now = time()
+        tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        return now + max(0, min(size, self.burst) - tokens) / self.rate
+
+
+class AQMDrop(Exception):
+    """Raised by a queue when its active queue management decides to drop a packet."""
+
+
+class RED:
+    """Random Early Detection on the average queue length (in packets).
+
+    Below min_th nothing is dropped, above max_th everything is dropped, and in
+    between packets are dropped with a probability growing linearly up to max_p.
+
+    """
+
+    name = "RED"
+
+    def __init__(self, min_th: float, max_th: float, max_p: float = 0.1, weight: float = 0.02) -> None:
+        assert min_th < max_th, "RED min threshold must be below max threshold"
+        self.min_th = min_th
+        self.max_th = max_th
+        self.max_p = max_p
+        self.weight = weight
+        self.avg = 0.0
+        # packets enqueued since the last early drop
+        self.count = 0
+
+    def drop_on_enqueue(self, qlen: int) -> bool:
+        self.avg = (1 - self.weight) * self.avg + self.weight * qlen
+        if self.avg < self.min_th:
+            self.count = 0
+            return False
+        if self.avg >= self.max_th:
+            self.count = 0
+            return True
+        p_b = self.max_p * (self.avg - self.min_th) / (self.max_th - self.min_th)
+        p_a = p_b / max(1 - self.count * p_b, 1e-9)
+        if random.random() < p_a:
+            self.count = 0
+            return True
+        self.count += 1
+        return False
+
+    def drop_on_dequeue(self, sojourn: float, now: float, qlen: int) -> bool:
+        return False
+
+
+class CoDel:
+    """Controlled Delay (RFC 8289) on the sojourn time of the packet at the head.
+
+    All times are in milliseconds, like the enqueue timestamp the queues record.
+
+    """
+
+    name = "CoDel"
+
+    def __init__(self, target: float = 5, interval: float = 100) -> None:
+        self.target = target
+        self.interval = interval
+        self.first_above_time = 0.0
+        self.drop_next = 0.0
+        self.count = 0
+        self.last_count = 0
+        self.dropping = False
+
+    def drop_on_enqueue(self, qlen: int) -> bool:
+        return False
+
+    def control_law(self, t: float) -> float:
+        return t + self.interval / (self.count ** 0.5)
+
+    def ok_to_drop(self, sojourn: float, now: float, qlen: int) -> bool:
+        # never drop the last packet in the queue
+        if sojourn < self.target or qlen == 0:
+            self.first_above_time = 0.0
+            return False
+        if self.first_above_time == 0:
+            self.first_above_time = now + self.interval
+            return False
+        return now >= self.first_above_time
+
+    def drop_on_dequeue(self, sojourn: float, now: float, qlen: int) -> bool:
+        ok = self.ok_to_drop(sojourn, now, qlen)
+        if self.dropping:
+            if not ok:
+                self.dropping = False
+                return False
+            if now >= self.drop_next:
+                self.count += 1
+                self.drop_next = self.control_law(self.drop_next)
+                return True
+            return False
+        if ok:
+            self.dropping = True
+            delta = self.count - self.last_count
+            # restart near the previous drop rate if we were dropping recently
+            if delta > 1 and now - self.drop_next < 16 * self.interval:
+                self.count = delta
+            else:
+                self.count = 1
+            self.last_count = self.count
+            self.drop_next = self.control_law(now)
+            return True
+        return False
+
+
+AQM = Union[RED, CoDel]
+
+
+def build_aqm(name: Union[str, None], params: List[float], queue_size: int) -> Union[AQM, None]:
+    """Creates a fresh AQM instance for one queue, or None for plain tail-drop."""
+    if name == "red":
+        # default thresholds at a quarter and three quarters of the queue
+        return RED(*params) if params else RED(queue_size / 4, queue_size * 3 / 4)
+    if name == "codel":
+        return CoDel(*params)
+    return None
 
 
 # Write our own wrapper class for the queue
 class NetworkQueue:
-    def __init__(self, queue_size: int) -> None:
+    def __init__(self, queue_size: int, aqm: Union[AQM, None] = None) -> None:
         self.queue_size = queue_size
         self.queue = deque()
+        self.aqm = aqm
+        # packets dropped by the AQM on dequeue, waiting to be logged by the emulator
+        self.aqm_drops: List[Queue_Entry] = []
 
     def __len__(self) -> int:
         return len(self.queue)
 
-    def enqueue(self, packet: bytes, entry: Table_Entry, source: Address, pri: int, length: int) -> None:
+    def check_aqm(self, packet: bytes) -> None:
+        # END packets are never dropped early, only when the queue is really full
+        if self.aqm and packet[17:18] != b"E" and self.aqm.drop_on_enqueue(len(self)):
+            raise AQMDrop(self.aqm.name)
+
+    def enqueue(self, packet: bytes, entry: Table_Entry, source: bytes, pri: int, length: int) -> None:
+        self.check_aqm(packet)
         if len(self.queue) < self.queue_size:
             # includes current time when enqueuing in miliseconds
             self.queue.appendleft(
-                (packet, time() * 1000, entry, source, pri, length))
+                (bytes(packet), time() * 1000, entry, source, pri, length))
         else:
             raise Exception("Queue is full")
 
-    def dequeue(self) -> Union[Queue_Entry, None]:
+    def pop(self) -> Union[Queue_Entry, None]:
         if len(self.queue) > 0:
             return self.queue.pop()
         else:
             return None
 
-    def peek(self) -> Union[Queue_Entry, None]:
-        return self.queue[-1] if len(self.queue) > 0 else None
+    def dequeue(self) -> Union[Queue_Entry, None]:
+        item = self.pop()
+        if self.aqm:
+            now = time() * 1000
+            while item and self.aqm.drop_on_dequeue(now - item[1], now, len(self)):
+                self.aqm_drops.append(item)
+                item = self.pop()
+        return item
+
+
+class RingNetworkQueue(NetworkQueue):
+    """A NetworkQueue backed by a preallocated ring buffer.
+
+    Packet bytes are copied into one contiguous bytearray arena and the per-packet
+    metadata lives in fixed-size arrays, so enqueueing allocates nothing and the
+    memory used by the queue is fixed up front. Besides the packet limit the queue
+    can be capped in bytes, so a queue of ACKs and a queue of DATA packets are
+    charged for what they actually hold.
+
+    """
+
+    def __init__(self, queue_size: int, aqm: Union[AQM, None] = None, capacity_bytes: Union[int, None] = None) -> None:
+        self.queue_size = queue_size
+        self.capacity_bytes = capacity_bytes
+        self.aqm = aqm
+        self.aqm_drops: List[Queue_Entry] = []
+        # one spare packet of room covers the space skipped when a packet wraps around
+        self.arena = bytearray((capacity_bytes or queue_size * MAX_PACKET) + MAX_PACKET)
+        self.offsets = array("I", [0]) * queue_size
+        self.sizes = array("I", [0]) * queue_size
+        self.times = array("d", [0.0]) * queue_size
+        self.priorities = array("B", [0]) * queue_size
+        self.lengths = array("I", [0]) * queue_size
+        self.entries: List[Union[Table_Entry, None]] = [None] * queue_size
+        self.sources: List[Union[bytes, None]] = [None] * queue_size
+        self.head_slot = 0
+        self.count = 0
+        # start of the oldest packet and end of the newest packet in the arena
+        self.head = 0
+        self.tail = 0
+        self.bytes_used = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def allocate(self, size: int) -> int:
+        """Returns the arena offset to store `size` bytes at, or -1 if they don't fit."""
+        if self.count == 0:
+            self.head = self.tail = 0
+        if self.count == 0 or self.tail > self.head:
+            if len(self.arena) - self.tail >= size:
+                return self.tail
+            # skip the rest of the arena and wrap around to the front
+            if self.head >= size:
+                return 0
+            return -1
+        return self.tail if self.head - self.tail >= size else -1
+
+    def enqueue(self, packet: bytes, entry: Table_Entry, source: bytes, pri: int, length: int) -> None:
+        self.check_aqm(packet)
+        size = len(packet)
+        if self.count >= self.queue_size or \
+                (self.capacity_bytes and self.bytes_used + size > self.capacity_bytes):
+            raise Exception("Queue is full")
+        offset = self.allocate(size)
+        if offset < 0:
+            raise Exception("Queue is full")
+
+        slot = (self.head_slot + self.count) % self.queue_size
+        self.arena[offset:offset + size] = packet
+        self.offsets[slot] = offset
+        self.sizes[slot] = size
+        # includes current time when enqueuing in miliseconds
+        self.times[slot] = time() * 1000
+        self.priorities[slot] = pri
+        self.lengths[slot] = length
+        self.entries[slot] = entry
+        self.sources[slot] = source
+        self.tail = offset + size
+        self.count += 1
+        self.bytes_used += size
+
+    def record(self, slot: int) -> Queue_Entry:
+        offset = self.offsets[slot]
+        return (bytes(self.arena[offset:offset + self.sizes[slot]]), self.times[slot], self.entries[slot],
+                self.sources[slot], self.priorities[slot], self.lengths[slot])
+
+    def pop(self) -> Union[Queue_Entry, None]:
+        if self.count == 0:
+            return None
+        slot = self.head_slot
+        item = self.record(slot)
+        self.entries[slot] = None
+        self.sources[slot] = None
+        self.bytes_used -= self.sizes[slot]
+        self.count -= 1
+        self.head_slot = (slot + 1) % self.queue_size
+        self.head = self.offsets[self.head_slot] if self.count else 0
+        return item
+
+
+class FairNetworkQueue(NetworkQueue):
+    """A NetworkQueue that keeps one sub-queue per flow and serves them round-robin.
+
+    A flow is keyed by the hash of its (source, destination) addresses. When the
+    queue is full the drop is taken from the longest flow, so one aggressive sender
+    cannot push every other flow of the same priority out of the queue.
+
+    """
+
+    def __init__(self, queue_size: int, aqm: Union[AQM, None] = None) -> None:
+        super().__init__(queue_size, aqm)
+        # maps flow key to that flow's own FIFO (same appendleft/pop order as NetworkQueue)
+        self.flows: Dict[int, deque] = {}
+        # flow keys that have packets waiting, in round-robin order
+        self.active = deque()
+        self.length = 0
+
+    def __len__(self) -> int:
+        return self.length
+
+    def enqueue(self, packet: bytes, entry: Table_Entry, source: bytes, pri: int, length: int) -> Union[Queue_Entry, None]:
+        """Enqueues the packet into its flow.
+
+        Returns the packet evicted from the longest flow to make room, if any. Raises
+        if the incoming packet's own flow is the longest, same as NetworkQueue.
+
+        """
+        self.check_aqm(packet)
+        key = hash((source, entry[0]))
+        flow = self.flows.get(key)
+        evicted = None
+        if self.length >= self.queue_size:
+            if not self.flows:
+                raise Exception("Queue is full")
+            longest = max(self.flows, key=lambda k: len(self.flows[k]))
+            if len(self.flows[longest]) <= (len(flow) if flow else 0) + 1:
+                raise Exception("Queue is full")
+            # drop the newest packet of the longest flow
+            evicted = self.flows[longest].popleft()
+            self.length -= 1
+
+        if flow is None:
+            flow = self.flows[key] = deque()
+            self.active.append(key)
+        flow.appendleft((bytes(packet), time() * 1000, entry, source, pri, length))
+        self.length += 1
+        return evicted
+
+    def pop(self) -> Union[Queue_Entry, None]:
+        if not self.active:
+            return None
+        key = self.active.popleft()
+        flow = self.flows[key]
+        item = flow.pop()
+        if flow:
+            self.active.append(key)
+        else:
+            del self.flows[key]
+        self.length -= 1
+        return item
 
 
 class Emulator:
     def __init__(
-        self, port: int, queue_size: int, filename: str, log_name: str
+        self, port: int, queue_size: int, filename: str, log_name: str, fair_queuing: bool = False,
+        aqm: Union[str, None] = None, aqm_params: Union[List[float], None] = None,
+        ring_queues: bool = False, queue_bytes: Union[int, None] = None, workers: int = 1,
+        autostart: bool = True, loss_model: str = "bernoulli", loss_params: Union[List[float], None] = None,
+        loss_trace: Union[str, None] = None, seed: Union[int, None] = None,
+        capture: Union[str, None] = None, control: Union[int, None] = None,
+        police: Union[Tuple[int, int], None] = None
     ) -> None:
+        # before anything logs, or the first call installs a default handler and the log file is never made
+        logging.basicConfig(
+            format='[%(asctime)s]\t%(message)s', filename=log_name, level=logging.DEBUG)
         self.filename = filename
         self.port = port
         self.queue_size = queue_size
+        self.fair_queuing = fair_queuing
+        self.aqm = aqm
+        self.aqm_params = aqm_params or []
+        self.ring_queues = ring_queues or queue_bytes is not None
+        self.queue_bytes = queue_bytes
         self.log_name = log_name
+        self.workers = workers
+        self.worker_id = 0
+        self.loss_model = loss_model
+        self.loss_params = loss_params or []
+        self.loss_trace = read_loss_trace(loss_trace) if loss_trace else None
+        self.seed = seed
         self.UDP_IP = socket.gethostbyname(socket.gethostname())
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sock.bind((self.UDP_IP, self.port))
-        # making it non-blocking
-        self.sock.setblocking(False)
+        # with several workers every worker binds its own socket after the fork
+        self.sock = self.open_socket() if workers <= 1 else None
 
-        # format: Queue_Entry -> (packet, time of enque, Table_Entry, source, priority, length)
+        # counts of forwarded, lost and dropped packets by reason
+        self.stats: DefaultDict[str, int] = defaultdict(int)
+        # where a worker process reports its stats to the parent
+        self.stats_queue = None
+
+        # pcapng capture of queued, forwarded and dropped packets; every worker and
+        # every emulator of a host agent writes its own file
+        self.capture_name = capture
+        self.capture: Union[PacketCapture, None] = None
+        if capture and not autostart:
+            self.capture = PacketCapture(f"{capture}.{port}")
+        elif capture and workers <= 1:
+            self.capture = PacketCapture(capture)
+
+        # optional per-source ingress policing: (rate in bytes/s, burst in bytes)
+        self.police = police
+        self.policers: Dict[bytes, TokenBucket] = {}
+
+        # format: Queue_Entry -> (packet, time of enque, Table_Entry, raw source, priority, length)
         self.currently_delaying: Union[Queue_Entry, None] = None
 
-        # format: Table_Entry -> (destination, next_hop, delay, loss_prob)
-        self.forwarding_table = self.read_forwarding_table()
+        # format: Table_Entry -> (destination, next_hop, delay, loss_prob, shaper, loss model)
+        self.install_table(self.read_forwarding_table())
 
-        self.high_priority_queue = NetworkQueue(self.queue_size)
-        self.medium_priority_queue = NetworkQueue(self.queue_size)
-        self.low_priority_queue = NetworkQueue(self.queue_size)
+        self.high_priority_queue = self.make_queue()
+        self.medium_priority_queue = self.make_queue()
+        self.low_priority_queue = self.make_queue()
         self.end_packet_queue = NetworkQueue(self.queue_size)
 
-        logging.basicConfig(
-            format='[%(asctime)s]\t%(message)s', filename=self.log_name, level=logging.DEBUG)
+        # JSON stats and runtime control over UDP on localhost; workers and host agent
+        # emulators use the following ports
+        self.control_port = control
+        self.control_sock: Union[socket.socket, None] = None
+        # counters per destination (raw route key) and sojourn histograms per priority
+        self.entry_stats: DefaultDict[bytes, DefaultDict[str, int]] = defaultdict(lambda: defaultdict(int))
+        self.sojourn_hist: Dict[int, List[int]] = {pri: [0] * HIST_BUCKETS for pri in (1, 2, 3)}
+        if control is not None and workers <= 1:
+            self.open_control()
+
         logging.info("Emulator started on port %d", self.port)
 
-        self.start()
+        if not autostart:
+            return
+        if workers > 1:
+            self.run_workers()
+            return
+        try:
+            self.start()
+        finally:
+            if self.capture:
+                self.capture.close()
+
+    def open_socket(self) -> socket.socket:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self.workers > 1:
+            # the kernel spreads datagrams over the workers by a hash of the 4-tuple,
+            # so all packets of one flow land on the same worker and stay in order
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.UDP_IP, self.port))
+        # making it non-blocking
+        sock.setblocking(False)
+        return sock
+
+    def run_workers(self) -> None:
+        """Forks one emulator per worker on the same port and merges their statistics.
+
+        The workers are forked after the forwarding table is read, so they all share it.
+
+        """
+        context = multiprocessing.get_context("fork")
+        self.stats_queue = context.Queue()
+        processes = [context.Process(target=self.run_worker, args=(i,), daemon=True)
+                     for i in range(self.workers)]
+        for p in processes:
+            p.start()
+        logging.info("Started %d workers on port %d", self.workers, self.port)
+
+        def stop(signum, frame):
+            raise KeyboardInterrupt
+        # SIGTERM (Popen.terminate) tears the workers down like Ctrl-C instead of orphaning them;
+        # installed after the fork so the workers keep the default handler
+        signal.signal(signal.SIGTERM, stop)
+
+        latest: Dict[int, Dict[str, int]] = {}
+        try:
+            while any(p.is_alive() for p in processes):
+                try:
+                    worker, stats = self.stats_queue.get(timeout=STATS_INTERVAL)
+                    latest[worker] = stats
+                except Exception:
+                    continue
+                # log the merged totals once per round of reports
+                if worker == 0:
+                    self.log_stats(merge_stats(latest.values()))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for p in processes:
+                p.terminate()
+            for p in processes:
+                p.join()
+            self.log_stats(merge_stats(latest.values()))
+
+    def run_worker(self, worker: int) -> None:
+        self.worker_id = worker
+        # give every worker its own loss streams instead of the copies made by fork
+        for i, e in enumerate(self.forwarding_table):
+            if e[5]:
+                e[5].reseed(stream_seed(self.seed, self.port, i, worker))
+        if self.capture_name:
+            self.capture = PacketCapture(f"{self.capture_name}.{worker}")
+        if self.control_port is not None:
+            self.control_port += worker
+            self.open_control()
+        self.sock = self.open_socket()
+        try:
+            self.start()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if self.capture:
+                self.capture.close()
+
+    def report_stats(self) -> None:
+        self.stats_queue.put((self.worker_id, dict(self.stats)))
+
+    def log_stats(self, stats: Dict[str, int]) -> None:
+        logging.info("Stats\t%s", ", ".join(f"{k}-{v}" for k, v in sorted(stats.items())))
+
+    def make_queue(self) -> NetworkQueue:
+        """Creates one priority queue according to the queueing options."""
+        aqm = build_aqm(self.aqm, self.aqm_params, self.queue_size)
+        if self.fair_queuing:
+            # split the priority class into per-flow round-robin sub-queues
+            return FairNetworkQueue(self.queue_size, aqm)
+        if self.ring_queues:
+            return RingNetworkQueue(self.queue_size, aqm, self.queue_bytes)
+        return NetworkQueue(self.queue_size, aqm)
+
+    def make_loss_model(self, loss_prob: int, index: int) -> Union[LossModel, None]:
+        """Creates the loss model of the index-th forwarding entry, None for a lossless one."""
+        if loss_prob <= 0:
+            return None
+        seed = stream_seed(self.seed, self.port, index, self.worker_id)
+        if self.loss_model == "gilbert":
+            return GilbertElliottLoss(*self.loss_params, seed=seed)
+        if self.loss_model == "trace":
+            return TraceLoss(self.loss_trace)
+        # loss_prob in the table is a percentage
+        return BernoulliLoss(loss_prob / 100, seed)
+
+    def install_table(self, entries: List[Table_Entry]) -> None:
+        """Switches to a new forwarding table; packets already queued keep their old entry."""
+        # the same entries keyed by the raw 6-byte destination as it appears in the header
+        routes: Dict[bytes, Table_Entry] = {}
+        for e in entries:
+            # like a linear scan, the first matching line wins
+            routes.setdefault(route_key(e[0]), e)
+        self.forwarding_table = entries
+        self.routes = routes
 
     def read_forwarding_table(self) -> List[Table_Entry]:
         entries: List[Table_Entry] = []
@@ -87,102 +593,349 @@ class Emulator:
                     next_hop = (socket.gethostbyname(line[4]), int(line[5]))
                     delay = int(line[6])
                     loss_prob = int(line[7])
-                    entries.append((destination, next_hop, delay, loss_prob))
+                    # optional bandwidth (bytes/s) and burst (bytes) columns
+                    shaper = None
+                    if len(line) > 8 and line[8].strip():
+                        burst = int(line[9]) if len(line) > 9 and line[9].strip() else DEFAULT_BURST
+                        shaper = TokenBucket(int(line[8]), burst)
+                    entries.append((destination, next_hop, delay, loss_prob, shaper,
+                                    self.make_loss_model(loss_prob, len(entries))))
                 else:
                     continue
         return entries
 
-    def route_packet(self, incoming_packet: bytes) -> None:
+    def route_packet(self, incoming_packet: Union[bytes, memoryview, None]) -> None:
+        if incoming_packet is not None:
+            self.enqueue_packet(incoming_packet)
+        self.release_packets()
 
-        if incoming_packet != None:
+    def enqueue_packet(self, incoming_packet: Union[bytes, memoryview]) -> None:
+        # incoming_packet may be a view of the receive buffer, so only the queues keep a copy
+        if len(incoming_packet) >= 17:
 
-            # unpack the packet
-            header = incoming_packet[:17]
-            payload = incoming_packet[17:]
-            priority, src_addr, src_port, dest_addr, dest_port, length = struct.unpack(
-                STRUCT_FORMAT, header
-            )
-            priority = int(priority.decode())
-            src_addr = socket.inet_ntoa(src_addr.to_bytes(4, byteorder='big'))
-            dest_addr = socket.inet_ntoa(
-                dest_addr.to_bytes(4, byteorder='big'))
-            destination = (dest_addr, int(dest_port))
-
-            curr_entry = self.lookup_by_destination(destination)
+            # read the priority and the raw 6-byte destination straight from the header,
+            # the full header is only decoded when something has to be logged
+            priority = incoming_packet[0] - 48
+            curr_entry = self.routes.get(bytes(incoming_packet[7:13]))
 
             if not curr_entry:
-                self.log("No forwarding entry found", src_addr, src_port,
-                         dest_addr, dest_port, priority, length)
+                self.drop("no_route", "No forwarding entry found", incoming_packet)
+                return
+
+            # END packets are never dropped for their sender's rate, as with full queues
+            if self.police and incoming_packet[17:18] != b"E" and not self.admit(incoming_packet):
+                self.drop("policed", "Dropped by the ingress policer", incoming_packet)
+                return
+
+            # cut-through: nothing is waiting and the route has no delay or shaping
+            if not curr_entry[2] and not curr_entry[4] and not self.currently_delaying and \
+                    not len(self.high_priority_queue) and not len(self.medium_priority_queue) and \
+                    not len(self.low_priority_queue) and 1 <= priority <= 3:
+                if not curr_entry[5] or not curr_entry[5].lost():
+                    self.sock.sendto(incoming_packet, curr_entry[0])
+                    self.count_forwarded(incoming_packet)
+                else:
+                    self.drop("lost", "Loss event occurred", incoming_packet)
                 return
 
+            source = bytes(incoming_packet[1:7])
+            length = len(incoming_packet)
+            evicted = None
             try:
                 if priority == 1:
-                    self.high_priority_queue.enqueue(
-                        incoming_packet, curr_entry, (src_addr, src_port), priority, length)
+                    evicted = self.high_priority_queue.enqueue(
+                        incoming_packet, curr_entry, source, priority, length)
                 elif priority == 2:
-                    self.medium_priority_queue.enqueue(
-                        incoming_packet, curr_entry, (src_addr, src_port), priority, length)
+                    evicted = self.medium_priority_queue.enqueue(
+                        incoming_packet, curr_entry, source, priority, length)
                 elif priority == 3:
-                    self.low_priority_queue.enqueue(
-                        incoming_packet, curr_entry, (src_addr, src_port), priority, length)
-            except:
+                    evicted = self.low_priority_queue.enqueue(
+                        incoming_packet, curr_entry, source, priority, length)
+            except Exception as e:
                 # test if is END packet
-                packet_type, seq, _ = struct.unpack("!cII", payload)
-                if packet_type == b"E":
-                    self.end_packet_queue.enqueue(
-                        incoming_packet, curr_entry, (src_addr, src_port), priority, length)
+                if incoming_packet[17:18] == b"E":
+                    try:
+                        self.end_packet_queue.enqueue(
+                            incoming_packet, curr_entry, source, priority, length)
+                    except Exception:
+                        self.drop("queue_full", "Dropped END packet because the END queue is full",
+                                  incoming_packet)
+                elif isinstance(e, AQMDrop):
+                    self.drop("aqm", f"Dropped by {e} in queue {priority}", incoming_packet)
                 else:
-                    self.log(f"Dropped because queue {priority} is full",
-                             src_addr, src_port, dest_addr, dest_port, priority, length)
-
-        # get a packet from the queues if there's no currently delayed packet
-        if not self.currently_delaying:
-            for Q in [self.high_priority_queue, self.medium_priority_queue, self.low_priority_queue]:
-                if Q.peek():
-                    self.currently_delaying = Q.dequeue()
-                    break
-        else:
+                    self.drop("queue_full", f"Dropped because queue {priority} is full", incoming_packet)
+            else:
+                if self.capture:
+                    self.capture.record(f"Queued in queue {priority}", incoming_packet)
+            if evicted:
+                self.drop("queue_full", f"Dropped from the longest flow because queue {priority} is full",
+                          evicted[0])
+
+    def admit(self, packet: Union[bytes, memoryview]) -> bool:
+        """Charges the packet to its source's token bucket; False if the source is over its rate."""
+        source = bytes(packet[1:7])
+        policer = self.policers.get(source)
+        if policer is None:
+            policer = self.policers[source] = TokenBucket(*self.police)
+        return policer.consume(len(packet))
+
+    def next_packet(self) -> Union[Queue_Entry, None]:
+        """Dequeues the next packet to delay, highest priority first."""
+        for Q in [self.high_priority_queue, self.medium_priority_queue, self.low_priority_queue]:
+            if len(Q):
+                entry = Q.dequeue()
+                self.log_aqm_drops(Q)
+                if entry:
+                    if self.control_sock:
+                        sojourn = int(time() * 1000 - entry[1])
+                        self.sojourn_hist[entry[4]][min(sojourn.bit_length(), HIST_BUCKETS - 1)] += 1
+                    return entry
+        return None
+
+    def release_packets(self) -> None:
+        """Forwards every packet whose delay is over.
+
+        The delay of a packet counts from when it was enqueued, so after one packet
+        is released the next one may already be due and goes out in the same call.
+
+        """
+        now = time() * 1000
+        while 1:
+            # get a packet from the queues if there's no currently delayed packet
+            if not self.currently_delaying:
+                self.currently_delaying = self.next_packet()
+                if not self.currently_delaying:
+                    return
             # decide if the delay is over and should be forwarded
-            if time() * 1000 - self.currently_delaying[1] >= self.currently_delaying[2][2]:
-                if random.random() > self.currently_delaying[2][3]:
-                    # forward according to loss_prob
-                    self.sock.sendto(
-                        self.currently_delaying[0], self.currently_delaying[2][0])
-                else:
-                    self.log("Loss event occurred", self.currently_delaying[3][0], self.currently_delaying[3][1], self.currently_delaying[
-                             2][0][0], self.currently_delaying[2][0][1], self.currently_delaying[4], self.currently_delaying[5])
-                self.currently_delaying = None
+            shaper = self.currently_delaying[2][4]
+            if now - self.currently_delaying[1] < self.currently_delaying[2][2] or \
+                    (shaper and not shaper.consume(len(self.currently_delaying[0]))):
+                return
+            loss = self.currently_delaying[2][5]
+            if not loss or not loss.lost():
+                # forward according to the route's loss model
+                self.sock.sendto(self.currently_delaying[0], self.currently_delaying[2][0])
+                self.count_forwarded(self.currently_delaying[0])
+            else:
+                self.drop("lost", "Loss event occurred", self.currently_delaying[0])
+            self.currently_delaying = None
 
-    def lookup_by_destination(self, destination: Address) -> Union[Table_Entry, None]:
-        """Returns the routing table entry that has the given destination address.
+    def next_deadline(self) -> Union[float, None]:
+        """Returns when (in ms) release_packets next has work to do, or None if idle."""
+        if self.currently_delaying:
+            deadline = self.currently_delaying[1] + self.currently_delaying[2][2]
+            shaper = self.currently_delaying[2][4]
+            if shaper:
+                # a packet past its delay still waits for its route's tokens
+                deadline = max(deadline, shaper.ready_at(len(self.currently_delaying[0])) * 1000)
+            return deadline
+        if len(self.high_priority_queue) or len(self.medium_priority_queue) or len(self.low_priority_queue):
+            return time() * 1000
+        return None
 
-        If there is no such entry, returns None.
+    def open_control(self) -> None:
+        self.control_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.control_sock.bind(("127.0.0.1", self.control_port))
+        self.control_sock.setblocking(False)
+        logging.info("Control socket listening on port %d", self.control_port)
+
+    def serve_control(self) -> None:
+        """Answers every waiting control request with a JSON reply.
+
+        Requests are JSON objects with a "cmd" of "stats", "set" (with a "destination"
+        of "host:port" and a new "delay" and/or "loss_prob") or "reload".
 
         """
+        while 1:
+            try:
+                request, address = self.control_sock.recvfrom(MAX_PACKET)
+            except OSError:
+                return
+            try:
+                reply = self.handle_control(json.loads(request))
+            except Exception as e:
+                reply = {"error": str(e)}
+            try:
+                self.control_sock.sendto(json.dumps(reply).encode(), address)
+            except OSError as e:
+                # e.g. a stats reply of a large table that doesn't fit in one datagram
+                logging.info("Control reply to %s failed: %s", address, e)
+                try:
+                    self.control_sock.sendto(json.dumps({"error": f"reply not sent: {e}"}).encode(), address)
+                except OSError:
+                    pass
+
+    def handle_control(self, request: Dict) -> Dict:
+        cmd = request.get("cmd")
+        if cmd == "stats":
+            return self.control_stats()
+        if cmd == "reload":
+            self.install_table(self.read_forwarding_table())
+            logging.info("Reloaded forwarding table from %s", self.filename)
+            return {"ok": True, "entries": len(self.forwarding_table)}
+        if cmd == "set":
+            host, port = request["destination"].rsplit(":", 1)
+            destination = (socket.gethostbyname(host), int(port))
+            entries = list(self.forwarding_table)
+            for i, e in enumerate(entries):
+                if e[0] == destination:
+                    delay = int(request.get("delay", e[2]))
+                    loss_prob = int(request.get("loss_prob", e[3]))
+                    loss = e[5] if loss_prob == e[3] else self.make_loss_model(loss_prob, i)
+                    entries[i] = (e[0], e[1], delay, loss_prob, e[4], loss)
+                    self.install_table(entries)
+                    logging.info("Set delay %d and loss_prob %d for %s:%d", delay, loss_prob, *destination)
+                    return {"ok": True}
+            return {"error": "No forwarding entry found"}
+        return {"error": f"Unknown command {cmd}"}
+
+    def control_stats(self) -> Dict:
+        queues = {}
+        for pri, Q in [(1, self.high_priority_queue), (2, self.medium_priority_queue), (3, self.low_priority_queue)]:
+            queues[pri] = {
+                "depth": len(Q),
+                # bucket i counts sojourn times below 2**i ms
+                "sojourn_ms": {f"<{2 ** i}": n for i, n in enumerate(self.sojourn_hist[pri]) if n},
+            }
+        entries = []
         for e in self.forwarding_table:
-            if destination == e[0]:
-                return e
-        return None
+            entries.append({
+                "destination": f"{e[0][0]}:{e[0][1]}",
+                "next_hop": f"{e[1][0]}:{e[1][1]}",
+                "delay": e[2],
+                "loss_prob": e[3],
+                "counters": dict(self.entry_stats.get(route_key(e[0]), {})),
+            })
+        return {"port": self.port, "stats": dict(self.stats), "queues": queues, "entries": entries}
 
     def log(self, message: str, src_addr: str, src_port: int, dest_addr: str, dest_port: int, priority: int, payload_size: int) -> None:
         logging.info("%s\t[src-%s:%d, dst-%s:%d, priority-%d, payload_size-%d]",
                      message, src_addr, src_port, dest_addr, dest_port, priority, payload_size)
 
+    def log_packet(self, message: str, packet: Union[bytes, memoryview]) -> None:
+        priority, src_addr, src_port, dest_addr, dest_port, length = struct.unpack_from(
+            STRUCT_FORMAT, packet)
+        self.log(message, socket.inet_ntoa(src_addr.to_bytes(4, byteorder='big')), src_port,
+                 socket.inet_ntoa(dest_addr.to_bytes(4, byteorder='big')), dest_port,
+                 int(priority.decode()), length)
+
+    def drop(self, reason: str, message: str, packet: Union[bytes, memoryview]) -> None:
+        """Counts, captures and logs a packet the emulator didn't forward."""
+        self.stats[reason] += 1
+        if self.control_sock:
+            self.entry_stats[bytes(packet[7:13])][reason] += 1
+        if self.capture:
+            self.capture.record(message, packet)
+        self.log_packet(message, packet)
+
+    def count_forwarded(self, packet: Union[bytes, memoryview]) -> None:
+        self.stats["forwarded"] += 1
+        if self.control_sock:
+            self.entry_stats[bytes(packet[7:13])]["forwarded"] += 1
+        if self.capture:
+            self.capture.record("Forwarded", packet)
+
+    def log_aqm_drops(self, queue: NetworkQueue) -> None:
+        for entry in queue.aqm_drops:
+            self.drop("aqm", f"Dropped by {queue.aqm.name} in queue {entry[4]}", entry[0])
+        queue.aqm_drops.clear()
+
     def start(self) -> None:
-        packet = None
+        # receive into one reusable buffer instead of a new bytes object per packet
+        buffer = bytearray(MAX_PACKET)
+        view = memoryview(buffer)
+        next_report = time() + STATS_INTERVAL
+        next_control = time() + CONTROL_INTERVAL
         while 1:
-            try:
-                packet, sender_addr = self.sock.recvfrom(8192)
-            except:
-                pass
-            self.route_packet(packet)
-            packet = None
+            # drain the ready input first, then release every packet that is due
+            for _ in range(MAX_BATCH):
+                try:
+                    size, sender_addr = self.sock.recvfrom_into(buffer)
+                except OSError:
+                    break
+                self.enqueue_packet(view[:size])
+            self.release_packets()
+            if self.stats_queue is None and self.control_sock is None:
+                continue
+            now = time()
+            if self.stats_queue is not None and now >= next_report:
+                next_report += STATS_INTERVAL
+                self.report_stats()
+            if self.control_sock is not None and now >= next_control:
+                next_control = now + CONTROL_INTERVAL
+                self.serve_control()
+
+
+def local_ports(filename: str) -> List[int]:
+    """Returns the emulator ports the forwarding table lists for this host, in file order."""
+    ports: List[int] = []
+    with open(filename, "r") as f:
+        for line in f:
+            line = line.split(" ")
+            if len(line) > 1 and line[0] == socket.gethostname() and int(line[1]) not in ports:
+                ports.append(int(line[1]))
+    return ports
+
+
+class HostAgent:
+    """Runs every emulator the forwarding table lists for this host in one process.
+
+    Each emulator keeps its own socket and queues, and one selector loop drives all of
+    them, sleeping until a socket is readable or a delayed or shaped packet is due.
+
+    """
+
+    def __init__(self, queue_size: int, filename: str, log_name: str, **options) -> None:
+        control = options.pop("control", None)
+        self.emulators = [Emulator(port, queue_size, filename, log_name, autostart=False,
+                                   control=None if control is None else control + i, **options)
+                          for i, port in enumerate(local_ports(filename))]
+        assert self.emulators, "No emulator in the forwarding table for this host"
+        logging.info("Host agent running emulators on ports %s",
+                     ", ".join(str(e.port) for e in self.emulators))
+
+        self.selector = selectors.DefaultSelector()
+        for e in self.emulators:
+            self.selector.register(e.sock, selectors.EVENT_READ, e)
+            if e.control_sock:
+                self.selector.register(e.control_sock, selectors.EVENT_READ, e)
+        try:
+            self.start()
+        finally:
+            for e in self.emulators:
+                if e.capture:
+                    e.capture.close()
+
+    def timeout(self) -> float:
+        """Seconds until the earliest delayed packet is due, at most one second."""
+        deadlines = [d for d in (e.next_deadline() for e in self.emulators) if d is not None]
+        if not deadlines:
+            return 1
+        return min(max(0, (min(deadlines) - time() * 1000) / 1000), 1)
+
+    def start(self) -> None:
+        buffer = bytearray(MAX_PACKET)
+        view = memoryview(buffer)
+        while 1:
+            for key, _ in self.selector.select(self.timeout()):
+                emulator = key.data
+                if key.fileobj is emulator.control_sock:
+                    emulator.serve_control()
+                    continue
+                for _ in range(MAX_BATCH):
+                    try:
+                        size, sender_addr = emulator.sock.recvfrom_into(buffer)
+                    except OSError:
+                        break
+                    emulator.enqueue_packet(view[:size])
+            for emulator in self.emulators:
+                emulator.release_packets()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Network Emulator")
-    parser.add_argument("-p", help="the port of the emulator",
-                        type=int, required=True)
+    parser.add_argument("-p", help="the port of the emulator (not needed with --all)",
+                        type=int, default=None)
     parser.add_argument(
         "-q", help="the size of each of the three queues", type=int, required=True
     )
@@ -194,7 +947,51 @@ if __name__ == "__main__":
     )
     parser.add_argument("-l", help="the name of the log file",
                         type=str, required=True)
+    parser.add_argument("--fair", help="use per-flow round-robin sub-queues inside each priority queue",
+                        action="store_true")
+    parser.add_argument("--aqm", help="active queue management for the priority queues (default: tail-drop)",
+                        choices=["red", "codel"], default=None)
+    parser.add_argument("--aqm-params", help="RED: min_th max_th [max_p [weight]] in packets; CoDel: target interval in ms",
+                        type=float, nargs="+", default=None)
+    parser.add_argument("--ring", help="store queued packets in preallocated ring buffers",
+                        action="store_true")
+    parser.add_argument("--queue-bytes", help="also cap each priority queue at this many bytes (implies --ring)",
+                        type=int, default=None)
+    parser.add_argument("--workers", help="number of worker processes sharing the port with SO_REUSEPORT "
+                        "(token buckets are per worker)", type=int, default=1)
+    parser.add_argument("--all", help="run every emulator listed for this host in one process",
+                        action="store_true")
+    parser.add_argument("--loss-model", help="how routes with a non-zero loss_prob lose packets",
+                        choices=["bernoulli", "gilbert", "trace"], default="bernoulli")
+    parser.add_argument("--loss-params", help="Gilbert-Elliott: p r [h [k]] transition and loss probabilities",
+                        type=float, nargs="+", default=None)
+    parser.add_argument("--loss-trace", help="file of 0/1 values replayed per packet by the trace loss model",
+                        type=str, default=None)
+    parser.add_argument("--seed", help="seed for reproducible losses", type=int, default=None)
+    parser.add_argument("--capture", help="write queued, forwarded and dropped packets to this pcapng file",
+                        type=str, default=None)
+    parser.add_argument("--police", help="police every source (src_addr, src_port) to RATE bytes/s with bursts of BURST bytes",
+                        type=int, nargs=2, metavar=("RATE", "BURST"), default=None)
+    parser.add_argument("--control", help="localhost UDP port serving JSON stats and accepting runtime changes",
+                        type=int, default=None)
 
     args = parser.parse_args()
-    # initialize Emulator
-    Emulator(args.p, args.q, args.f, args.l)
+    if args.fair and (args.ring or args.queue_bytes is not None):
+        parser.error("--fair cannot be combined with --ring or --queue-bytes")
+    if args.all and args.workers > 1:
+        parser.error("--all cannot be combined with --workers")
+    if not args.all and args.p is None:
+        parser.error("-p is required unless --all is given")
+    if args.loss_model == "gilbert" and (not args.loss_params or len(args.loss_params) < 2):
+        parser.error("--loss-model gilbert needs at least p and r in --loss-params")
+    if args.loss_model == "trace" and not args.loss_trace:
+        parser.error("--loss-model trace needs --loss-trace")
+    options = dict(fair_queuing=args.fair, aqm=args.aqm, aqm_params=args.aqm_params,
+                   ring_queues=args.ring, queue_bytes=args.queue_bytes, loss_model=args.loss_model,
+                   loss_params=args.loss_params, loss_trace=args.loss_trace, seed=args.seed,
+                   capture=args.capture, control=args.control, police=args.police)
+    if args.all:
+        HostAgent(args.q, args.f, args.l, **options)
+    else:
+        # initialize Emulator
+        Emulator(args.p, args.q, args.f, args.l, workers=args.workers, **options)
@@ -0,0 +1,133 @@
+import random
+from typing import List, Union
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# how many random numbers a model draws at once
+BLOCK_SIZE = 4096
+
+
+class RandomStream:
+    """Uniform random numbers in [0, 1), drawn in blocks instead of one call per packet.
+
+    Uses NumPy when it is installed and falls back to the random module otherwise.
+    The same seed always gives the same stream.
+
+    """
+
+    def __init__(self, seed: Union[int, None] = None, block_size: int = BLOCK_SIZE) -> None:
+        self.block_size = block_size
+        self.reseed(seed)
+
+    def reseed(self, seed: Union[int, None]) -> None:
+        self.rng = numpy.random.default_rng(seed) if numpy else random.Random(seed)
+        self.values: List[float] = []
+        self.index = 0
+
+    def block(self) -> List[float]:
+        if numpy:
+            # tolist() so that each packet reads a plain float, not a NumPy scalar
+            return self.rng.random(self.block_size).tolist()
+        return [self.rng.random() for _ in range(self.block_size)]
+
+    def next(self) -> float:
+        if self.index >= len(self.values):
+            self.values = self.block()
+            self.index = 0
+        value = self.values[self.index]
+        self.index += 1
+        return value
+
+
+class BernoulliLoss:
+    """Loses every packet independently with probability p."""
+
+    def __init__(self, p: float, seed: Union[int, None] = None) -> None:
+        self.p = p
+        self.stream = RandomStream(seed)
+        self.decisions: List[bool] = []
+        self.index = 0
+
+    def reseed(self, seed: Union[int, None]) -> None:
+        self.stream.reseed(seed)
+        self.decisions = []
+        self.index = 0
+
+    def lost(self) -> bool:
+        if self.index >= len(self.decisions):
+            # decide a whole block of packets at once
+            if numpy:
+                self.decisions = (self.stream.rng.random(self.stream.block_size) < self.p).tolist()
+            else:
+                self.decisions = [v < self.p for v in self.stream.block()]
+            self.index = 0
+        decision = self.decisions[self.index]
+        self.index += 1
+        return decision
+
+
+class GilbertElliottLoss:
+    """Bursty loss from a two-state Markov chain.
+
+    The chain moves from the good to the bad state with probability p and back with
+    probability r after every packet. A packet is lost with probability k in the good
+    state and h in the bad state; the defaults give the simple Gilbert model.
+
+    """
+
+    def __init__(self, p: float, r: float, h: float = 1.0, k: float = 0.0, seed: Union[int, None] = None) -> None:
+        self.p = p
+        self.r = r
+        self.h = h
+        self.k = k
+        self.bad = False
+        self.stream = RandomStream(seed)
+
+    def reseed(self, seed: Union[int, None]) -> None:
+        self.stream.reseed(seed)
+        self.bad = False
+
+    def lost(self) -> bool:
+        lost = self.stream.next() < (self.h if self.bad else self.k)
+        if self.bad:
+            self.bad = self.stream.next() >= self.r
+        else:
+            self.bad = self.stream.next() < self.p
+        return lost
+
+
+class TraceLoss:
+    """Replays a recorded loss pattern, one entry per packet, starting over at the end."""
+
+    def __init__(self, pattern: List[bool]) -> None:
+        assert pattern, "Loss trace is empty"
+        self.pattern = pattern
+        self.index = 0
+
+    def reseed(self, seed: Union[int, None]) -> None:
+        self.index = 0
+
+    def lost(self) -> bool:
+        decision = self.pattern[self.index]
+        self.index = (self.index + 1) % len(self.pattern)
+        return decision
+
+
+LossModel = Union[BernoulliLoss, GilbertElliottLoss, TraceLoss]
+
+
+def read_loss_trace(filename: str) -> List[bool]:
+    """Reads a loss trace: whitespace separated 0/1 values, 1 meaning the packet is lost."""
+    with open(filename, "r") as f:
+        return [v != "0" for v in f.read().split()]
+
+
+def stream_seed(seed: Union[int, None], *parts: int) -> Union[int, None]:
+    """Derives the seed of one random stream, so every route gets its own reproducible stream."""
+    if seed is None:
+        return None
+    # hashes of int tuples don't change between runs
+    return hash((seed,) + parts) & 0xFFFFFFFF
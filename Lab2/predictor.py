@@ -0,0 +1,136 @@
+import argparse
+import math
+from typing import List, Tuple
+
+try:
+    import numpy
+except ImportError:
+    raise SystemExit("predictor.py needs NumPy, install it with: pip install numpy")
+
+# outer header + inner header added to every payload
+HEADER_SIZE = 17 + 9
+# how many times the sender tries a missing packet before giving up on it
+MAX_TRIALS = 5
+
+# (emulator, destination, next hop, delay in ms, loss in percent, bandwidth in bytes/s or 0)
+Route = Tuple[str, str, str, int, int, int]
+
+
+def read_table(filename: str) -> List[Route]:
+    """Reads every line of a forwarding table, whichever emulator it belongs to."""
+    routes: List[Route] = []
+    with open(filename, "r") as f:
+        for line in f:
+            line = line.split()
+            if len(line) < 8:
+                continue
+            bandwidth = int(line[8]) if len(line) > 8 else 0
+            routes.append((f"{line[0]}:{line[1]}", f"{line[2]}:{line[3]}", f"{line[4]}:{line[5]}",
+                           int(line[6]), int(line[7]), bandwidth))
+    return routes
+
+
+def window_schedule(n: int, rate: float, delay: float, queue_size: int, service: float) -> Tuple[List[bool], List[float]]:
+    """Follows n packets sent 1/rate seconds apart through one emulator route.
+
+    Uses the emulator's rules: one packet at a time is delayed, its delay counts
+    from when it was enqueued, it can't leave before the previous one, a shaped
+    route needs `service` seconds per packet, and a packet that finds `queue_size`
+    packets waiting is dropped. Returns which packets are dropped and when the
+    others leave the emulator, in seconds from the first send.
+
+    """
+    dropped: List[bool] = []
+    departures: List[float] = []
+    # times at which accepted packets leave the queue to be delayed
+    dequeues: List[float] = []
+    last_departure = -math.inf
+    for i in range(n):
+        arrival = i / rate
+        waiting = sum(1 for d in dequeues if d > arrival)
+        if waiting >= queue_size:
+            dropped.append(True)
+            departures.append(math.nan)
+            continue
+        dequeue = max(arrival, last_departure)
+        last_departure = max(arrival + delay, dequeue, last_departure + service)
+        dequeues.append(dequeue)
+        dropped.append(False)
+        departures.append(last_departure)
+    return dropped, departures
+
+
+def predict_route(route: Route, size: int, window: int, timeout: float, rate: float, length: int,
+                  queue_size: int, ack_delay: float, transfers: int, rng) -> dict:
+    """Simulates `transfers` transfers of `size` bytes over one route at once."""
+    _, _, _, delay, loss_prob, bandwidth = route
+    p = loss_prob / 100
+    delay_s = delay / 1000
+    ack_s = ack_delay / 1000
+    service = (length + HEADER_SIZE) / bandwidth if bandwidth else 0.0
+    rtt = delay_s + service + ack_s
+
+    packets = max(1, math.ceil(size / length))
+    elapsed = numpy.zeros(transfers)
+    retransmits = numpy.zeros(transfers)
+    failed = numpy.zeros(transfers)
+    schedules = {}
+    for start in range(0, packets, window):
+        n = min(window, packets - start)
+        if n not in schedules:
+            schedules[n] = window_schedule(n, rate, delay_s, queue_size, service)
+        dropped, departures = schedules[n]
+        dropped = numpy.array(dropped)
+        acks = numpy.array(departures) + ack_s
+
+        # packets the queue dropped or the route lost
+        missing = dropped | (rng.random((transfers, n)) < p)
+        delivered_acks = numpy.where(missing, -numpy.inf, acks)
+        # the sender waits for the last ack, and one timeout for every ack that never comes
+        elapsed += numpy.maximum(n / rate, delivered_acks.max(axis=1)) + missing.sum(axis=1) * timeout
+
+        # each missing packet is resent alone until it gets through or runs out of trials
+        success = rng.random((transfers, n, MAX_TRIALS)) >= p
+        got_through = success.any(axis=2)
+        attempts = numpy.where(got_through, success.argmax(axis=2) + 1, MAX_TRIALS)
+        cost = (attempts - 1) * (timeout + 1 / rate) + numpy.where(got_through, rtt, timeout)
+        elapsed += (cost * missing).sum(axis=1)
+        retransmits += (attempts * missing).sum(axis=1)
+        failed += (~got_through & missing).sum(axis=1)
+
+    delivered = (packets - failed) / packets * size
+    goodput = delivered / elapsed
+    p50, p90, p99 = numpy.percentile(elapsed, [50, 90, 99])
+    return {
+        "goodput": goodput.mean(),
+        "retransmit_rate": retransmits.sum() / (transfers * packets + retransmits.sum()),
+        "failed_packets": failed.sum() / (transfers * packets),
+        "p50": p50,
+        "p90": p90,
+        "p99": p99,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Predict goodput over every route of a forwarding table")
+    parser.add_argument("-f", help="the forwarding table", type=str, required=True)
+    parser.add_argument("-w", help="the requester's window size", type=int, required=True)
+    parser.add_argument("-t", help="the sender's retransmission timeout in milliseconds", type=int, required=True)
+    parser.add_argument("-r", help="the number of packets sent per second", type=int, required=True)
+    parser.add_argument("-l", help="the length of the payload (in bytes) in the packets", type=int, required=True)
+    parser.add_argument("-q", help="the size of each of the emulator's queues", type=int, default=100)
+    parser.add_argument("--size", help="the size of the transferred file in bytes", type=int, default=100000)
+    parser.add_argument("--ack-delay", help="delay of the return path for acks in milliseconds",
+                        type=float, default=0)
+    parser.add_argument("--transfers", help="number of simulated transfers per route", type=int, default=10000)
+    parser.add_argument("--seed", help="seed for reproducible predictions", type=int, default=None)
+    args = parser.parse_args()
+
+    rng = numpy.random.default_rng(args.seed)
+    print(f"{'emulator':<22}{'destination':<22}{'goodput B/s':>14}{'retx':>8}{'failed':>8}"
+          f"{'p50 s':>10}{'p90 s':>10}{'p99 s':>10}")
+    for route in read_table(args.f):
+        result = predict_route(route, args.size, args.w, args.t / 1000, args.r, args.l, args.q,
+                               args.ack_delay, args.transfers, rng)
+        print(f"{route[0]:<22}{route[1]:<22}{result['goodput']:>14.1f}{result['retransmit_rate']:>8.2%}"
+              f"{result['failed_packets']:>8.2%}{result['p50']:>10.3f}{result['p90']:>10.3f}{result['p99']:>10.3f}")
@@ -0,0 +1,333 @@
+import argparse
+import heapq
+import itertools
+import random
+import shlex
+import socket as real_socket
+import threading
+import time as real_time
+import traceback
+import types
+from collections import defaultdict, deque
+from datetime import datetime
+from typing import Callable, Deque, Dict, List, Tuple, Union
+
+import emulator
+import requester
+import sender
+
+Address = Tuple[str, int]
+# the address of the host the simulated programs run on; other host names get their own
+SIM_IP = "127.0.0.1"
+# how long an emulator waits for tokens before looking at a shaped route again, in seconds
+SHAPER_TICK = 0.001
+
+
+class Process:
+    """One simulated program, run in its own thread.
+
+    Only one process runs at a time: a process runs until it blocks on the simulation
+    (sleep, recvfrom) or ends, and then hands control back to the scheduler.
+
+    """
+
+    def __init__(self, sim: "Simulation", name: str, target: Callable[[], None], daemon: bool = False) -> None:
+        self.sim = sim
+        self.name = name
+        self.target = target
+        # daemon processes (the emulators) don't keep the simulation going
+        self.daemon = daemon
+        self.go = threading.Event()
+        self.waiting = False
+        self.timed_out = False
+        self.wait_id = 0
+        self.done = False
+        self.error: Union[str, None] = None
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+
+    def run(self) -> None:
+        self.go.wait()
+        self.go.clear()
+        try:
+            self.target()
+        except BaseException:
+            self.error = traceback.format_exc()
+        self.done = True
+        self.sim.back.set()
+
+    def block(self) -> None:
+        self.sim.back.set()
+        self.go.wait()
+        self.go.clear()
+
+
+class Simulation:
+    """A virtual clock and an in-memory UDP network shared by all simulated processes.
+
+    Time only moves forward when every process is blocked, jumping straight to the
+    next timer, so waiting costs nothing and a run is the same every time.
+
+    """
+
+    def __init__(self, hostname: str = "localhost") -> None:
+        self.hostname = hostname
+        self.now = 0.0
+        # heap of (time, tie breaker, process, wait id)
+        self.timers: List[Tuple[float, int, Process, int]] = []
+        self.counter = itertools.count()
+        self.network: Dict[Address, "SimSocket"] = {}
+        # maps host names to their fake addresses, so the same port on two hosts is two sockets
+        self.hosts: Dict[str, str] = {hostname: SIM_IP, "localhost": SIM_IP}
+        # datagrams sent to an address nobody bound, usually a host that isn't simulated
+        self.undelivered: Dict[Address, int] = defaultdict(int)
+        self.ports = itertools.count(40000)
+        self.processes: List[Process] = []
+        self.ready: Deque[Process] = deque()
+        self.current: Union[Process, None] = None
+        self.back = threading.Event()
+
+    def spawn(self, name: str, target: Callable[[], None], daemon: bool = False) -> Process:
+        process = Process(self, name, target, daemon)
+        self.processes.append(process)
+        self.ready.append(process)
+        process.thread.start()
+        return process
+
+    def gethostbyname(self, name: str) -> str:
+        """Gives every host name its own address, like DNS would; addresses map to themselves."""
+        try:
+            real_socket.inet_aton(name)
+            return name
+        except OSError:
+            pass
+        if name not in self.hosts:
+            n = len(self.hosts)
+            self.hosts[name] = f"10.0.{n // 256}.{n % 256}"
+        return self.hosts[name]
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.wait(seconds)
+
+    def wait(self, timeout: Union[float, None]) -> bool:
+        """Blocks the current process until notify() or the timeout; False on timeout."""
+        process = self.current
+        assert process is not None, "Only simulated processes can block"
+        process.wait_id += 1
+        process.waiting = True
+        process.timed_out = False
+        if timeout is not None:
+            heapq.heappush(self.timers, (self.now + max(timeout, 0), next(self.counter), process, process.wait_id))
+        process.block()
+        return not process.timed_out
+
+    def notify(self, process: Process) -> None:
+        if process.waiting:
+            process.waiting = False
+            self.ready.append(process)
+
+    def run(self, until: Union[float, None] = None) -> None:
+        """Runs until every non-daemon process ends, nothing can happen anymore, or `until`."""
+        while any(not p.done for p in self.processes if not p.daemon):
+            if self.ready:
+                process = self.ready.popleft()
+                self.current = process
+                process.go.set()
+                self.back.wait()
+                self.back.clear()
+                self.current = None
+                continue
+            if not self.timers:
+                # every process is blocked for good
+                return
+            at, _, process, wait_id = heapq.heappop(self.timers)
+            if not process.waiting or process.wait_id != wait_id:
+                continue
+            if until is not None and at > until:
+                self.now = until
+                return
+            self.now = max(self.now, at)
+            process.timed_out = True
+            self.notify(process)
+
+
+class SimSocket:
+    """An in-memory UDP socket with the subset of the socket API the labs use."""
+
+    def __init__(self, sim: Simulation, *args) -> None:
+        self.sim = sim
+        self.address: Union[Address, None] = None
+        self.inbox: Deque[Tuple[bytes, Address]] = deque()
+        # None blocks forever, 0 is non-blocking
+        self.timeout: Union[float, None] = None
+        self.waiter: Union[Process, None] = None
+
+    def bind(self, address: Address) -> None:
+        host, port = address
+        # a wildcard bind still only receives what is sent to this host
+        host = SIM_IP if host in ("", "0.0.0.0") else self.sim.gethostbyname(host)
+        self.address = (host, port or next(self.sim.ports))
+        assert self.address not in self.sim.network, f"Address {self.address} already in use"
+        self.sim.network[self.address] = self
+
+    def setsockopt(self, *args) -> None:
+        pass
+
+    def settimeout(self, timeout: Union[float, None]) -> None:
+        self.timeout = timeout
+
+    def setblocking(self, flag: bool) -> None:
+        self.timeout = None if flag else 0
+
+    def close(self) -> None:
+        if self.address:
+            self.sim.network.pop(self.address, None)
+
+    def sendto(self, data: bytes, address: Address) -> int:
+        if self.address is None:
+            self.bind((SIM_IP, 0))
+        address = (self.sim.gethostbyname(address[0]), address[1])
+        destination = self.sim.network.get(address)
+        # like UDP, a datagram to nobody just disappears
+        if not destination:
+            self.sim.undelivered[address] += 1
+        else:
+            destination.inbox.append((bytes(data), self.address))
+            if destination.waiter:
+                self.sim.notify(destination.waiter)
+        return len(data)
+
+    def recvfrom(self, size: int) -> Tuple[bytes, Address]:
+        if not self.inbox:
+            if self.timeout == 0:
+                raise BlockingIOError("no datagram waiting")
+            self.waiter = self.sim.current
+            self.sim.wait(self.timeout)
+            self.waiter = None
+            if not self.inbox:
+                raise TimeoutError("timed out")
+        data, address = self.inbox.popleft()
+        return data[:size], address
+
+    def recvfrom_into(self, buffer: bytearray) -> Tuple[int, Address]:
+        data, address = self.recvfrom(len(buffer))
+        buffer[:len(data)] = data
+        return len(data), address
+
+
+def socket_module(sim: Simulation) -> types.SimpleNamespace:
+    """Stands in for the socket module inside the simulated programs."""
+    module = types.SimpleNamespace(**{k: getattr(real_socket, k) for k in dir(real_socket) if not k.startswith("__")})
+    module.socket = lambda *args: SimSocket(sim, *args)
+    module.gethostname = lambda: sim.hostname
+    module.gethostbyname = sim.gethostbyname
+    return module
+
+
+def datetime_class(sim: Simulation) -> type:
+    class SimDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return datetime.fromtimestamp(sim.now, tz)
+
+    return SimDatetime
+
+
+def run_emulator(sim: Simulation, e: emulator.Emulator) -> None:
+    """Drives an emulator the way HostAgent does, sleeping in virtual time between events."""
+    buffer = bytearray(emulator.MAX_PACKET)
+    view = memoryview(buffer)
+    while 1:
+        while e.sock.inbox:
+            size, sender_addr = e.sock.recvfrom_into(buffer)
+            e.enqueue_packet(view[:size])
+        e.release_packets()
+        if e.sock.inbox:
+            # a route back to this emulator itself; nothing would wake us up for it
+            continue
+        deadline = e.next_deadline()
+        e.sock.waiter = sim.current
+        # a packet still held after its deadline waits for its shaper's tokens
+        sim.wait(None if deadline is None else max(deadline / 1000 - sim.now, SHAPER_TICK))
+        e.sock.waiter = None
+
+
+def install(sim: Simulation) -> None:
+    """Points the lab programs at the simulated clock, network and clock-based datetime."""
+    fake_socket = socket_module(sim)
+    fake_time = types.SimpleNamespace(time=sim.time, sleep=sim.sleep)
+    emulator.socket = fake_socket
+    emulator.time = sim.time
+    for module in (sender, requester):
+        module.socket = fake_socket
+        module.time = fake_time
+        module.datetime = datetime_class(sim)
+
+
+def parse_sender(args: str) -> Callable[[], None]:
+    parser = argparse.ArgumentParser(prog="sender")
+    for flag in "pgrqleit":
+        parser.add_argument(f"-{flag}", type=int, required=True)
+    parser.add_argument("-f", type=str, required=True)
+    a = parser.parse_args(shlex.split(args))
+    return lambda: sender.Sender(a.p, a.g, a.r, a.q, a.l, str(a.i), a.f, a.e, a.t)
+
+
+def parse_requester(args: str) -> Callable[[], None]:
+    parser = argparse.ArgumentParser(prog="requester")
+    parser.add_argument("-p", type=int, required=True)
+    parser.add_argument("-o", type=str, required=True)
+    parser.add_argument("-f", type=str, required=True)
+    parser.add_argument("-e", type=int, required=True)
+    parser.add_argument("-w", type=int, required=True)
+    a = parser.parse_args(shlex.split(args))
+    return lambda: requester.Requester(a.p, a.o, a.f, a.e, a.w)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Discrete-event simulation of the Lab2 emulator, senders and requesters")
+    parser.add_argument("-f", help="the forwarding table", type=str, required=True)
+    parser.add_argument("-q", help="the size of each of the three queues", type=int, required=True)
+    parser.add_argument("-l", help="the name of the emulator log file", type=str, required=True)
+    parser.add_argument("--hostname", help="the host name the simulated programs run on",
+                        type=str, default="localhost")
+    parser.add_argument("--sender", help="sender arguments, e.g. \"-p 5001 -g 4000 -r 10 -q 1 -l 100 -f localhost -e 5000 -i 1 -t 100\"",
+                        type=str, action="append", default=[])
+    parser.add_argument("--requester", help="requester arguments, e.g. \"-p 4000 -o file.txt -f localhost -e 5000 -w 10\"",
+                        type=str, action="append", default=[])
+    parser.add_argument("--seed", help="seed for every random decision", type=int, default=0)
+    parser.add_argument("--until", help="stop after this many simulated seconds", type=float, default=None)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    sim = Simulation(args.hostname)
+    install(sim)
+
+    emulators = [emulator.Emulator(port, args.q, args.f, args.l, autostart=False, seed=args.seed)
+                 for port in emulator.local_ports(args.f)]
+    for e in emulators:
+        sim.spawn(f"emulator {e.port}", lambda e=e: run_emulator(sim, e), daemon=True)
+    # senders first, so that they are waiting for the request
+    for i, s in enumerate(args.sender):
+        sim.spawn(f"sender {i}", parse_sender(s))
+    for i, r in enumerate(args.requester):
+        sim.spawn(f"requester {i}", parse_requester(r))
+
+    started = real_time.time()
+    sim.run(args.until)
+    print()
+    print("Simulation")
+    print(f"Simulated time: {sim.now:.3f}s")
+    print(f"Wall time: {real_time.time() - started:.3f}s")
+    for p in sim.processes:
+        if not p.daemon:
+            print(f"{p.name}: {'failed' if p.error else 'finished' if p.done else 'still running'}")
+            if p.error:
+                print(p.error)
+    for e in emulators:
+        print(f"emulator {e.port}: " + ", ".join(f"{k}-{v}" for k, v in sorted(e.stats.items())))
+    names = {ip: name for name, ip in sim.hosts.items() if name != "localhost"}
+    for (ip, port), count in sorted(sim.undelivered.items()):
+        print(f"undelivered to {names.get(ip, ip)} {port} (not simulated): {count} packets")
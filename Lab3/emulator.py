@@ -1,64 +1,416 @@
 import socket
+import struct
 from dataclasses import dataclass
-import pickle
 import time
 import argparse
-from typing import Dict, List, Optional, Set, Tuple, Literal, Union
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Literal, Union
 from collections import defaultdict, deque
+from functools import lru_cache
+import heapq
 import logging
+import math
+import random
+import selectors
 
 Address = Tuple[str, int]
+# a directed adjacency u -> v, meaning v is in u's neighbor list
+Edge = Tuple[Address, Address]
+# seconds between log lines with CPU use and control traffic
+STATS_INTERVAL = 10
+# largest DBD or LSU datagram sent when two neighbors synchronize their topology
+SYNC_DATAGRAM = 1400
+
+# wire format: version, type, source (IPv4 + port), then per type
+#   HELLO: nothing
+#   LSM:   seq, ttl, neighbor count, neighbors (IPv4 + port each)
+#   TRACE: ttl, destination (IPv4 + port)
+#   DBD:   entry count, then (node IPv4 + port, seq) per entry
+#   LSU:   entry count, then (node IPv4 + port, seq, neighbor count, neighbors) per entry
+WIRE_VERSION = 1
+HEADER_FORMAT = "!BB4sH"
+ADDRESS_FORMAT = "!4sH"
+LSM_FORMAT = "!IHH"
+TRACE_FORMAT = "!H4sH"
+COUNT_FORMAT = "!H"
+SUMMARY_FORMAT = "!4sHI"
+UPDATE_FORMAT = "!4sHIH"
+PACKET_TYPES = {"HELLO": 1, "LSM": 2, "TRACE": 3, "DBD": 4, "LSU": 5}
+TYPE_NAMES = {v: k for k, v in PACKET_TYPES.items()}
+
+
+def pack_address(address: Address) -> Tuple[bytes, int]:
+    """Addresses are dotted IPv4 strings already; names are resolved once by whoever reads them."""
+    return socket.inet_aton(address[0]), address[1]
+
+
+@lru_cache(maxsize=4096)
+def packed_address(address: Address) -> bytes:
+    """ADDRESS_FORMAT bytes of an address; a network only has a handful, so they are cached."""
+    return struct.pack(ADDRESS_FORMAT, *pack_address(address))
+
+
+def unpack_address(ip: bytes, port: int) -> Address:
+    return (socket.inet_ntoa(ip), port)
 
 
 @dataclass
 class Message:
     source: Address
-    packet_type: Literal["HELLO", "LSM", "TRACE"]
+    packet_type: Literal["HELLO", "LSM", "TRACE", "DBD", "LSU"]
     seq_num: Optional[int] = None
     ttl: Optional[int] = None
     # since the cost is always 1, we only send adjacent nodes
     neighbors: Optional[Set[Address]] = None
     destination: Optional[Address] = None
+    # (node, seq, neighbors) of many nodes at once; DBDs leave the neighbors out
+    entries: Optional[List[Tuple[Address, int, Optional[Set[Address]]]]] = None
 
     def to_bytes(self) -> bytes:
-        return pickle.dumps(self)
+        data = struct.pack(HEADER_FORMAT, WIRE_VERSION, PACKET_TYPES[self.packet_type], *pack_address(self.source))
+        if self.packet_type == "LSM":
+            neighbors = self.neighbors or set()
+            data += struct.pack(LSM_FORMAT, self.seq_num, self.ttl, len(neighbors))
+            data += b"".join(packed_address(n) for n in neighbors)
+        elif self.packet_type == "TRACE":
+            data += struct.pack(TRACE_FORMAT, self.ttl, *pack_address(self.destination))
+        elif self.packet_type == "DBD":
+            data += struct.pack(COUNT_FORMAT, len(self.entries))
+            data += b"".join(packed_address(node) + struct.pack("!I", seq) for node, seq, _ in self.entries)
+        elif self.packet_type == "LSU":
+            data += struct.pack(COUNT_FORMAT, len(self.entries))
+            for node, seq, neighbors in self.entries:
+                data += struct.pack(UPDATE_FORMAT, *pack_address(node), seq, len(neighbors))
+                data += b"".join(packed_address(n) for n in neighbors)
+        return data
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "Message":
+        """Decodes a message made by to_bytes; raises ValueError on anything else."""
+        try:
+            version, packet_type, ip, port = struct.unpack_from(HEADER_FORMAT, data)
+            if version != WIRE_VERSION or packet_type not in TYPE_NAMES:
+                raise ValueError(f"Unknown message version {version} or type {packet_type}")
+            msg = cls(unpack_address(ip, port), TYPE_NAMES[packet_type])
+            offset = struct.calcsize(HEADER_FORMAT)
+            if msg.packet_type == "LSM":
+                msg.seq_num, msg.ttl, count = struct.unpack_from(LSM_FORMAT, data, offset)
+                offset += struct.calcsize(LSM_FORMAT)
+                msg.neighbors = {unpack_address(*struct.unpack_from(ADDRESS_FORMAT, data, offset + i * 6))
+                                 for i in range(count)}
+            elif msg.packet_type == "TRACE":
+                msg.ttl, ip, port = struct.unpack_from(TRACE_FORMAT, data, offset)
+                msg.destination = unpack_address(ip, port)
+            elif msg.packet_type in ("DBD", "LSU"):
+                count, = struct.unpack_from(COUNT_FORMAT, data, offset)
+                offset += struct.calcsize(COUNT_FORMAT)
+                msg.entries = []
+                for _ in range(count):
+                    if msg.packet_type == "DBD":
+                        ip, port, seq = struct.unpack_from(SUMMARY_FORMAT, data, offset)
+                        offset += struct.calcsize(SUMMARY_FORMAT)
+                        msg.entries.append((unpack_address(ip, port), seq, None))
+                        continue
+                    ip, port, seq, n = struct.unpack_from(UPDATE_FORMAT, data, offset)
+                    offset += struct.calcsize(UPDATE_FORMAT)
+                    neighbors = {unpack_address(*struct.unpack_from(ADDRESS_FORMAT, data, offset + i * 6))
+                                 for i in range(n)}
+                    offset += n * struct.calcsize(ADDRESS_FORMAT)
+                    msg.entries.append((unpack_address(ip, port), seq, neighbors))
+        except struct.error as e:
+            raise ValueError(f"Truncated message: {e}")
+        return msg
 
 
 class NeighborList:
-    def __init__(self, neighbors: Set[Address], timeout: float) -> None:
-        self.neighbors: List[Tuple[Address, float]] = []
+    """Tracks when each neighbor was last heard from.
+
+    A HELLO only overwrites the neighbor's last-seen time. The expiry heap keeps one
+    deadline per live neighbor; when a deadline passes, the neighbor is either dead or
+    its entry is pushed again with the deadline its last HELLO gives it.
+
+    A neighbor that is down comes up only after `up_count` HELLOs in a row, each within
+    the timeout of the one before, so a link that barely works doesn't bounce.
+
+    """
+
+    def __init__(self, neighbors: Set[Address], timeout: float, up_count: int = 1) -> None:
         self.timeout = timeout
+        self.up_count = up_count
+        self.last_seen: Dict[Address, float] = {}
+        self.expiry: List[Tuple[float, Address]] = []
+        # neighbors on their way up: address -> (HELLOs in a row, time of the last one)
+        self.pending: Dict[Address, Tuple[int, float]] = {}
 
+        now = time.monotonic()
         for n in neighbors:
-            self.neighbors.append((n, time.time()))
+            self.last_seen[n] = now
+            heapq.heappush(self.expiry, (now + timeout, n))
 
     def record_neighbor(self, neighbor: Address) -> Union[Tuple[Address, Literal["UP"]], None]:
-        if neighbor not in [n[0] for n in self.neighbors]:
-            # a neighbor is online
-            self.neighbors.append((neighbor, time.time()))
-            logging.debug(f"Neighbor {neighbor} is online")
-            return (neighbor, 'UP')
-        else:
-            old = None
-            for entry in self.neighbors:
-                if entry[0] == neighbor:
-                    old = entry
-            assert old != None
-            self.neighbors.remove(old)
-            self.neighbors.append((neighbor, time.time()))
+        now = time.monotonic()
+        if neighbor in self.last_seen:
+            self.last_seen[neighbor] = now
             logging.debug(f"Neighbor is already online, updated")
-
-    def check_timeout(self) -> Union[Tuple[Address, Literal["DOWN"]], None]:
-        for entry in self.neighbors:
-            if time.time() - entry[1] > self.timeout:
-                self.neighbors.remove(entry)
-                logging.debug(
-                    f"Neighbor {entry[0]} is offline due to timeout for {time.time() - entry[1]} seconds")
-                return (entry[0], "DOWN")
+            return None
+        count, seen = self.pending.get(neighbor, (0, now))
+        count = count + 1 if now - seen < self.timeout else 1
+        if count < self.up_count:
+            self.pending[neighbor] = (count, now)
+            logging.debug(f"Neighbor {neighbor} sent {count} of {self.up_count} HELLOs to come up")
+            return None
+        # a neighbor is online
+        self.pending.pop(neighbor, None)
+        self.last_seen[neighbor] = now
+        heapq.heappush(self.expiry, (now + self.timeout, neighbor))
+        logging.debug(f"Neighbor {neighbor} is online")
+        return (neighbor, 'UP')
+
+    def check_timeout(self) -> List[Address]:
+        """Returns every neighbor that has been silent for longer than the timeout."""
+        now = time.monotonic()
+        dead: List[Address] = []
+        while self.expiry and self.expiry[0][0] <= now:
+            _, neighbor = heapq.heappop(self.expiry)
+            seen = self.last_seen[neighbor]
+            if now - seen >= self.timeout:
+                del self.last_seen[neighbor]
+                dead.append(neighbor)
+                logging.debug(f"Neighbor {neighbor} is offline due to timeout for {now - seen} seconds")
+            else:
+                heapq.heappush(self.expiry, (seen + self.timeout, neighbor))
+        return dead
+
+    def next_expiry(self) -> Union[float, None]:
+        """The time.monotonic() at which check_timeout may next find a dead neighbor."""
+        return self.expiry[0][0] if self.expiry else None
+
+
+def first_hop_tree(root: Address, adj: Dict[Address, Set[Address]]) -> Tuple[Dict[Address, int], Dict[Address, Address]]:
+    """Runs one BFS from root and returns the hop count and first hop of every reachable node.
+
+    Among equally short paths the smallest first hop wins, so the result depends only on
+    the topology and not on the order sets are iterated in.
+
+    """
+    dist = {root: 0}
+    first_hops: Dict[Address, Address] = {}
+    frontier = deque([root])
+    while frontier:
+        current = frontier.popleft()
+        d = dist[current] + 1
+        for neighbor in adj.get(current, ()):
+            hop = neighbor if current == root else first_hops[current]
+            if neighbor not in dist:
+                dist[neighbor] = d
+                first_hops[neighbor] = hop
+                frontier.append(neighbor)
+            elif dist[neighbor] == d and hop < first_hops[neighbor]:
+                first_hops[neighbor] = hop
+    return dist, first_hops
+
+
+class ShortestPathTree:
+    """First hops from one root, kept up to date from individual adjacency changes.
+
+    update() only revisits the nodes an edge change can affect and always ends in
+    exactly the state first_hop_tree() would compute for the new topology.
+
+    """
+
+    def __init__(self, root: Address, adj: Dict[Address, Set[Address]]) -> None:
+        self.root = root
+        self.reset(adj)
+
+    def reset(self, adj: Dict[Address, Set[Address]]) -> None:
+        """Recomputes everything from a full adjacency list."""
+        self.out_edges: Dict[Address, Set[Address]] = defaultdict(set)
+        self.in_edges: Dict[Address, Set[Address]] = defaultdict(set)
+        for u, neighbors in adj.items():
+            for v in neighbors:
+                self.out_edges[u].add(v)
+                self.in_edges[v].add(u)
+        self.dist, self.first_hops = first_hop_tree(self.root, self.out_edges)
+
+    def best_hop(self, node: Address, d: int) -> Union[Address, None]:
+        """The smallest first hop over node's in-neighbors that are d - 1 hops away."""
+        hops = [node if x == self.root else self.first_hops[x]
+                for x in self.in_edges.get(node, ()) if self.dist.get(x) == d - 1]
+        return min(hops) if hops else None
+
+    def update(self, removed: Iterable[Edge], added: Iterable[Edge]) -> Set[Address]:
+        """Applies edge changes and returns the nodes whose first hop changed."""
+        removed = [(u, v) for u, v in removed if v in self.out_edges.get(u, ())]
+        before: Dict[Address, Union[Address, None]] = {}
+
+        # removals can only make nodes farther: the nodes whose shortest paths may have
+        # used a removed edge are recomputed from their untouched in-neighbors
+        for u, v in removed:
+            self.out_edges[u].discard(v)
+            self.in_edges[v].discard(u)
+        stack = [v for u, v in removed if u in self.dist and self.dist.get(v) == self.dist[u] + 1]
+        affected: Set[Address] = set()
+        while stack:
+            x = stack.pop()
+            if x in affected:
+                continue
+            affected.add(x)
+            for y in self.out_edges.get(x, ()):
+                if self.dist.get(y) == self.dist[x] + 1:
+                    stack.append(y)
+        for x in affected:
+            before[x] = self.first_hops.pop(x)
+            del self.dist[x]
+        heap = []
+        for y in affected:
+            d = min((self.dist[x] + 1 for x in self.in_edges.get(y, ()) if x in self.dist), default=None)
+            if d is not None:
+                heapq.heappush(heap, (d, y))
+        while heap:
+            d, y = heapq.heappop(heap)
+            if y in self.dist:
+                continue
+            self.dist[y] = d
+            self.first_hops[y] = self.best_hop(y, d)
+            for z in self.out_edges.get(y, ()):
+                if z in affected and z not in self.dist:
+                    heapq.heappush(heap, (d + 1, z))
+
+        # additions can only make nodes closer or give them a smaller first hop
+        heap = []
+        added = [(u, v) for u, v in added if v not in self.out_edges.get(u, ())]
+        for u, v in added:
+            self.out_edges[u].add(v)
+            self.in_edges[v].add(u)
+            if u in self.dist:
+                heapq.heappush(heap, (self.dist[u] + 1, v))
+        while heap:
+            d, y = heapq.heappop(heap)
+            if y == self.root or self.dist.get(y, d) < d:
+                continue
+            hop = self.best_hop(y, d)
+            if y in self.dist and self.dist[y] == d and self.first_hops[y] == hop:
+                continue
+            before.setdefault(y, self.first_hops.get(y))
+            self.dist[y] = d
+            self.first_hops[y] = hop
+            for z in self.out_edges.get(y, ()):
+                heapq.heappush(heap, (d + 1, z))
+
+        return {x for x, hop in before.items() if self.first_hops.get(x) != hop}
+
+
+class SpfThrottle:
+    """Collects topology changes and decides when the forwarding table is rebuilt.
+
+    The first change after a quiet period waits `initial` seconds, so that the rest of
+    a burst of LSMs lands in the same run. While changes keep coming the wait between
+    runs doubles from `hold` up to `maximum`; it starts over after `maximum` seconds
+    without a run.
+
+    """
+
+    def __init__(self, initial: float, hold: float, maximum: float) -> None:
+        self.initial = initial
+        self.hold = hold
+        self.maximum = maximum
+        self.current_hold = hold
+        self.last_run = -float("inf")
+        self.due: Union[float, None] = None
+        # edge -> whether it exists after the pending changes, the last change wins
+        self.edges: Dict[Edge, bool] = {}
+        self.dead_nodes: Set[Address] = set()
+
+    def schedule(self, now: float, removed: Iterable[Edge] = (), added: Iterable[Edge] = (),
+                 dead_node: Union[Address, None] = None) -> None:
+        for e in removed:
+            self.edges[e] = False
+        for e in added:
+            self.edges[e] = True
+            # a node we hear from again is no longer dead
+            self.dead_nodes.discard(e[1])
+        if dead_node:
+            self.dead_nodes.add(dead_node)
+        if self.due is None:
+            if now - self.last_run >= self.maximum:
+                self.current_hold = self.hold
+                self.due = now + self.initial
+            else:
+                self.due = max(now + self.initial, self.last_run + self.current_hold)
+
+    def ready(self, now: float) -> bool:
+        return self.due is not None and now >= self.due
+
+    def take(self, now: float) -> Tuple[List[Edge], List[Edge], Set[Address]]:
+        """Returns and clears the pending (removed, added, dead nodes)."""
+        if now - self.last_run < self.maximum:
+            self.current_hold = min(self.current_hold * 2, self.maximum)
+        self.last_run = now
+        self.due = None
+        removed = [e for e, exists in self.edges.items() if not exists]
+        added = [e for e, exists in self.edges.items() if exists]
+        pending = (removed, added, self.dead_nodes)
+        self.edges = {}
+        self.dead_nodes = set()
+        return pending
+
+
+class FlapDampening:
+    """Keeps neighbors that keep going down from being announced again right away.
+
+    Every time a neighbor goes down it gets `penalty` points, which halve every
+    `half_life` seconds. Above `suppress` points the neighbor is suppressed: coming
+    back up is not announced until the penalty has decayed below `reuse`. Penalties
+    are capped so that no neighbor stays suppressed longer than `max_suppress` seconds.
+
+    """
+
+    def __init__(self, half_life: float = 15, suppress: float = 2000, reuse: float = 750,
+                 penalty: float = 1000, max_suppress: float = 60) -> None:
+        assert reuse < suppress, "The reuse threshold must be below the suppress threshold"
+        self.half_life = half_life
+        self.suppress = suppress
+        self.reuse = reuse
+        self.penalty = penalty
+        self.ceiling = reuse * 2 ** (max_suppress / half_life)
+        # neighbor -> (penalty, when it was last updated)
+        self.penalties: Dict[Address, Tuple[float, float]] = {}
+        self.suppressed: Set[Address] = set()
+
+    def current(self, node: Address, now: float) -> float:
+        value, at = self.penalties.get(node, (0, now))
+        return value * 0.5 ** ((now - at) / self.half_life)
+
+    def flap(self, node: Address, now: float) -> None:
+        value = min(self.current(node, now) + self.penalty, self.ceiling)
+        self.penalties[node] = (value, now)
+        if value >= self.suppress and node not in self.suppressed:
+            logging.info(f"Neighbor {node} flaps too often, suppressed for {self.reuse_time(node, now) - now:.1f} seconds")
+            self.suppressed.add(node)
+
+    def is_suppressed(self, node: Address, now: float) -> bool:
+        if node in self.suppressed and now >= self.reuse_time(node, now):
+            self.suppressed.discard(node)
+        return node in self.suppressed
+
+    def reuse_time(self, node: Address, now: float) -> float:
+        value, at = self.penalties[node]
+        return at + self.half_life * math.log2(value / self.reuse) if value > self.reuse else now
+
+    def next_reuse(self) -> Union[float, None]:
+        return min((self.reuse_time(n, 0) for n in self.suppressed), default=None)
+
+    def release(self, now: float) -> List[Address]:
+        """Returns and forgets the suppressed neighbors whose penalty has decayed."""
+        released = [n for n in self.suppressed if now >= self.reuse_time(n, now)]
+        self.suppressed.difference_update(released)
+        return released
 
 
 class Emulator:
-    def __init__(self, port: int, filename: str) -> None:
+    def __init__(self, port: int, filename: str, spf_initial: float = 0.05, spf_hold: float = 0.2,
+                 spf_max: float = 2.0, lsm_refresh: float = 30, hello_interval: float = 1.5,
+                 detect_multiplier: float = 2.5, up_count: int = 1,
+                 dampening: Union[FlapDampening, None] = None) -> None:
         self.port = port
         self.topo_file = filename
 
@@ -75,18 +427,32 @@ class Emulator:
         # self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
         self.address = (self.ip, self.port)
-        self.lsm_interval = 1.5  # in seconds
-        self.hello_interval = 1.5  # timeout for neighbor nodes
-        self.timout = 3.5
+        # LSMs are sent when our links change, and again every lsm_refresh seconds minus up to
+        # a quarter of jitter so that nodes don't refresh in lockstep
+        self.lsm_refresh = lsm_refresh
+        # an LSM not refreshed for this long is removed from the topology
+        self.lsm_max_age = 3 * lsm_refresh
+        # HELLOs go out every hello_interval seconds minus up to a quarter of jitter, and a
+        # neighbor is dead after detect_multiplier intervals without one
+        self.hello_interval = hello_interval
+        self.timout = hello_interval * detect_multiplier
+        self.up_count = up_count
         self.sequence_no = 0
-        self.last_hello_sent = time.time()
-        self.last_LSM_sent = time.time()
+        self.next_hello = time.monotonic()
+        self.next_LSM_refresh = time.monotonic() + self.refresh_delay()
+        self.next_age_check = time.monotonic() + 1
+        self.next_stats = time.monotonic() + STATS_INTERVAL
+        self.last_cpu = (time.monotonic(), time.process_time())
         self.offline_repr: Address = ('125.125.125.125', -1)
         # maps (dst_addr, dst_ip) to (next_hop_addr, next_hop_ip)
         self.forwarding_table: Dict[Address, Address] = {}
         self.all_nodes_except_self: List[Address] = []
         self.adj_list: Dict[Address, Set[Address]] = defaultdict(set)
         self.sequence_tracking: Dict[Address, int] = defaultdict(int)
+        # when the newest LSM of every node arrived
+        self.lsm_heard: Dict[Address, float] = {}
+        # HELLOs and LSMs sent, received and dropped, logged every STATS_INTERVAL
+        self.control_stats: Dict[str, int] = defaultdict(int)
 
         logging.basicConfig(
             format='[%(asctime)s]  === %(levelname)s ===  %(message)s', level=logging.INFO)
@@ -94,8 +460,15 @@ class Emulator:
 
         self.read_topology()
         self.ttl = len(self.all_nodes_except_self) + 1
+        self.lsm_heard = {node: time.monotonic() for node in self.all_nodes_except_self}
         self.neighbor_list = NeighborList(
-            set(self.neighbors), self.timout)
+            set(self.neighbors), self.timout, self.up_count)
+        self.spf = ShortestPathTree(self.address, self.adj_list)
+        self.spf_throttle = SpfThrottle(spf_initial, spf_hold, spf_max)
+        self.spf_runs = 0
+        self.dampening = dampening or FlapDampening()
+        # the same 8 bytes every time, so they are encoded once
+        self.hello = Message(source=self.address, packet_type='HELLO').to_bytes()
         self.build_forwarding_table()
         self.emulate()
 
@@ -125,9 +498,9 @@ class Emulator:
         self.print_topology()
         self.print_forwarding_table()
 
-    def update_adj_list(self, msg: Message) -> bool:
+    def update_adj_list(self, msg: Message) -> Union[Tuple[List[Edge], List[Edge]], None]:
         """
-        returns True if adjacency list changed, False if nothing changed
+        returns the (removed, added) edges if adjacency list changed, None if nothing changed
         """
         assert msg.seq_num != None, "For Link State packet, sequence number must be present"
         assert msg.neighbors != None, "For Link State packet, neighbor list must be present"
@@ -135,22 +508,19 @@ class Emulator:
 
         if self.sequence_tracking[msg.source] >= msg.seq_num:
             logging.debug(f"Adjacency list remains the same because the received LSM is outdated")
-            return False
+            return None
 
         old = self.adj_list[msg.source]
         new = msg.neighbors
 
-        if new:
-            if old == new:
-                self.sequence_tracking[msg.source] = msg.seq_num
-                logging.debug(f"Adjacency list remains the same but the received LSM is newer")
-                return False
-            else:
-                self.sequence_tracking[msg.source] = msg.seq_num
-                self.adj_list[msg.source] = new
-                logging.debug(f"Adjacency list changed")
-
-        return True
+        # an empty list is news too: the node lost every link
+        self.sequence_tracking[msg.source] = msg.seq_num
+        if old == new:
+            logging.debug(f"Adjacency list remains the same but the received LSM is newer")
+            return None
+        self.adj_list[msg.source] = new
+        logging.debug(f"Adjacency list changed")
+        return ([(msg.source, n) for n in old - new], [(msg.source, n) for n in new - old])
     
     def print_topology(self) -> None:
         print()
@@ -168,40 +538,41 @@ class Emulator:
                 print(str(k)[1:-1], str(v)[1:-1])
         print()
 
-    def build_forwarding_table(self, dead_node: Union[Address, None] = None) -> None:
+    def build_forwarding_table(self, dead_nodes: Iterable[Address] = (),
+                               removed: Iterable[Edge] = (), added: Iterable[Edge] = ()) -> None:
+        """Updates the forwarding table.
+
+        Given the edges that changed, only the destinations they affect are recomputed;
+        without them the whole table is rebuilt from the adjacency list. Dead neighbors are
+        always rewritten, so one that is still reachable keeps a route.
+
+        """
         logging.info("Building forwarding table")
-        if dead_node and not self.adj_list[self.address]:
+        removed, added, dead_nodes = list(removed), list(added), set(dead_nodes)
+        if removed or added:
+            changed = self.spf.update(removed, added)
+        else:
+            self.spf.reset(self.adj_list)
+            changed = self.all_nodes_except_self
+        if dead_nodes and not self.adj_list[self.address]:
             logging.debug("No neighbor is online, empty forwarding table")
-            self.forwarding_table[dead_node] = self.offline_repr
-            self.print_topology()
-            self.print_forwarding_table()
-            return
-        for node in [x for x in self.all_nodes_except_self if x != dead_node]:
-            result = self.forward_search(self.address, node)
-            if result:
-                self.forwarding_table[node] = result[1]
-            else:
-                self.forwarding_table[node] = self.offline_repr
-            if dead_node:
-                self.forwarding_table[dead_node] = self.offline_repr
+        # a dead neighbor may still be reachable through another one, so it takes its route from the tree too
+        for node in [x for x in set(changed) | dead_nodes if x != self.address]:
+            self.forwarding_table[node] = self.spf.first_hops.get(node, self.offline_repr)
         self.print_topology()
         self.print_forwarding_table()
 
-    def forward_search(self, start: Address, goal: Address) -> List[Address]:
-        frontier = deque([(start, [start])])
-        visited: Set[Address] = set()
-
-        while frontier:
-            current, path = deque.popleft(frontier)
-            visited.add(current)
-
-            for neighbor in self.adj_list[current]:
-                if neighbor == goal:
-                    return path + [neighbor]
-                elif neighbor not in visited:
-                    frontier.append((neighbor, path + [neighbor]))
+    def schedule_spf(self, removed: Iterable[Edge] = (), added: Iterable[Edge] = (),
+                     dead_node: Union[Address, None] = None) -> None:
+        """Records a topology change; the table is rebuilt later by run_spf."""
+        self.spf_throttle.schedule(time.monotonic(), removed, added, dead_node)
 
-        return []
+    def run_spf(self) -> None:
+        """Applies every change collected since the last run in one rebuild."""
+        removed, added, dead_nodes = self.spf_throttle.take(time.monotonic())
+        self.spf_runs += 1
+        logging.info(f"SPF run {self.spf_runs} with {len(removed)} removed and {len(added)} added edges")
+        self.build_forwarding_table(dead_nodes, removed, added)
 
     def send_msg(self, msg: Message, dest: Address) -> None:
         self.sock.sendto(msg.to_bytes(), dest)
@@ -209,40 +580,145 @@ class Emulator:
 
     def broadcast_to_neighbors(self, msg: Message) -> None:
         if self.adj_list[self.address]:
+            # encoded once for all neighbors
+            data = msg.to_bytes()
             for neighbor in self.adj_list[self.address]:
-                self.send_msg(msg, neighbor)
+                self.sock.sendto(data, neighbor)
             logging.debug(f"Sent a {msg.packet_type} packet to neighbors")
         else:
             logging.debug(f"Try to broadcast {msg.packet_type} but no neighbor is online")
     
     def broadcast_to_neighbors_except(self, msg: Message, _except: Address) -> None:
         if self.adj_list[self.address]:
+            data = msg.to_bytes()
             for neighbor in self.adj_list[self.address]:
                 if neighbor != _except:
-                    self.send_msg(msg, neighbor)
+                    self.sock.sendto(data, neighbor)
             logging.debug(f"Sent a {msg.packet_type} packet to neighbors")
         else:
             logging.debug(f"Try to broadcast {msg.packet_type} but no neighbor is online")
 
-    def emulate_once(self, msg: Message) -> None:
-        logging.info(f"Received {msg.packet_type} packet from {msg.source}")
+    def refresh_delay(self) -> float:
+        return self.lsm_refresh * random.uniform(0.75, 1)
+
+    def originate_lsm(self) -> None:
+        """Floods our current neighbor list with a new sequence number."""
+        self.sequence_no += 1
+        self.broadcast_to_neighbors(Message(
+            source=self.address,
+            packet_type='LSM',
+            seq_num=self.sequence_no,
+            ttl=self.ttl,
+            neighbors=self.adj_list[self.address]
+        ))
+        self.control_stats["lsm_originated"] += 1
+        self.next_LSM_refresh = time.monotonic() + self.refresh_delay()
+
+    def age_lsdb(self) -> None:
+        """Removes the links of every node whose LSM has not been refreshed for lsm_max_age."""
+        now = time.monotonic()
+        for node, heard in self.lsm_heard.items():
+            if now - heard > self.lsm_max_age and self.adj_list[node]:
+                logging.info(f"LSM from {node} is {now - heard:.1f} seconds old, removing its links")
+                removed = [(node, n) for n in self.adj_list[node]]
+                self.adj_list[node] = set()
+                # whatever it sends next is accepted
+                self.sequence_tracking[node] = 0
+                self.control_stats["lsm_aged"] += 1
+                self.schedule_spf(removed)
+
+    def lsdb_summary(self) -> List[Tuple[Address, int]]:
+        """(node, seq) of every LSM we know, ours included; nodes never heard from are left out."""
+        summary = [(self.address, self.sequence_no)] if self.sequence_no else []
+        return summary + [(n, self.sequence_tracking[n]) for n in self.all_nodes_except_self
+                          if self.sequence_tracking[n]]
+
+    def send_entries(self, packet_type: Literal["DBD", "LSU"],
+                     entries: List[Tuple[Address, int, Optional[Set[Address]]]], dest: Address) -> None:
+        """Sends entries in as few datagrams of at most SYNC_DATAGRAM bytes as possible."""
+        fixed = struct.calcsize(HEADER_FORMAT) + struct.calcsize(COUNT_FORMAT)
+        batch, size = [], fixed
+        for entry in entries:
+            if packet_type == "DBD":
+                entry_size = struct.calcsize(SUMMARY_FORMAT)
+            else:
+                entry_size = struct.calcsize(UPDATE_FORMAT) + len(entry[2]) * struct.calcsize(ADDRESS_FORMAT)
+            if batch and size + entry_size > SYNC_DATAGRAM:
+                self.send_msg(Message(source=self.address, packet_type=packet_type, entries=batch), dest)
+                self.control_stats[f"{packet_type.lower()}_sent"] += 1
+                batch, size = [], fixed
+            batch.append(entry)
+            size += entry_size
+        # an empty DBD still asks the neighbor for everything it has
+        if batch or packet_type == "DBD":
+            self.send_msg(Message(source=self.address, packet_type=packet_type, entries=batch), dest)
+            self.control_stats[f"{packet_type.lower()}_sent"] += 1
+
+    def sync_with(self, neighbor: Address) -> None:
+        """Starts a database exchange: the neighbor answers with every LSM it has that is newer than ours."""
+        self.send_entries("DBD", [(node, seq, None) for node, seq in self.lsdb_summary()], neighbor)
+
+    def log_stats(self) -> None:
+        """Logs the control traffic and the CPU share of this process since the last call."""
+        now, cpu = time.monotonic(), time.process_time()
+        share = (cpu - self.last_cpu[1]) / (now - self.last_cpu[0]) if now > self.last_cpu[0] else 0
+        self.last_cpu = (now, cpu)
+        logging.info(f"CPU {share:.1%}, " + ", ".join(f"{k}-{v}" for k, v in sorted(self.control_stats.items())))
+
+    def emulate_once(self, msg: Message, sender: Union[Address, None] = None) -> None:
         # If message is HELLO
         if msg.packet_type == "HELLO":
+            # HELLOs can come every few milliseconds, so they are only logged when debugging
+            logging.debug(f"Received HELLO packet from {msg.source}")
+            self.control_stats["hello_received"] += 1
             result = self.neighbor_list.record_neighbor(msg.source)
             if result:
-                self.adj_list[self.address].add(result[0])
-                self.adj_list[result[0]].add(self.address)
-                self.sequence_tracking[result[0]] = 0
-                self.build_forwarding_table()
+                if self.dampening.is_suppressed(result[0], time.monotonic()):
+                    logging.info(f"Neighbor {result[0]} is up but suppressed for flapping")
+                    self.control_stats["flap_suppressed"] += 1
+                else:
+                    self.neighbor_up(result[0])
+            return
+        logging.info(f"Received {msg.packet_type} packet from {msg.source}")
         # If message is Link State
-        elif msg.packet_type == "LSM":
+        if msg.packet_type == "LSM":
             assert msg.ttl != None, "For Link State packet, ttl must be present"
+            if msg.source == self.address and msg.seq_num > self.sequence_no:
+                # an LSM we sent before restarting: continue numbering above it, or ours are ignored
+                logging.info(f"Found our own LSM {msg.seq_num} from before a restart")
+                self.sequence_no = msg.seq_num
+                self.originate_lsm()
+                return
+            if msg.source == self.address or msg.seq_num <= self.sequence_tracking[msg.source]:
+                # our own LSM coming back or one we have already flooded, so it stops here
+                self.control_stats["lsm_suppressed"] += 1
+                return
             if msg.ttl > 0:
-                if self.update_adj_list(msg):
+                self.lsm_heard[msg.source] = time.monotonic()
+                delta = self.update_adj_list(msg)
+                if delta:
                     logging.info(f"Network topoloy changed according to a LSM from {msg.source}")
-                    self.build_forwarding_table()
+                    self.schedule_spf(removed=delta[0], added=delta[1])
                 msg.ttl -= 1
-                self.broadcast_to_neighbors_except(msg, msg.source)
+                self.broadcast_to_neighbors_except(msg, sender or msg.source)
+                self.control_stats["lsm_flooded"] += 1
+
+        # If message is a database summary, send back everything newer than what it lists
+        elif msg.packet_type == "DBD":
+            theirs = {node: seq for node, seq, _ in msg.entries}
+            if theirs.get(self.address, 0) > self.sequence_no:
+                # same as finding our own LSM from before a restart
+                self.sequence_no = theirs[self.address]
+                self.originate_lsm()
+            summary = self.lsdb_summary()
+            newer = [(node, seq, self.adj_list[node]) for node, seq in summary if seq > theirs.get(node, 0)]
+            logging.info(f"Sending {len(newer)} of {len(summary)} LSMs to {msg.source}")
+            self.send_entries("LSU", newer, sender or msg.source)
+
+        # If message is a bulk update, every entry is handled and flooded like its own LSM
+        elif msg.packet_type == "LSU":
+            for node, seq, neighbors in msg.entries:
+                self.emulate_once(Message(node, "LSM", seq, self.ttl, neighbors), sender)
 
         # If message is Traceroute
         elif msg.packet_type == "TRACE":
@@ -268,55 +744,113 @@ class Emulator:
 
     def emulate(self) -> None:
         logging.info("Starting emulator main loop")
+        # a restarted node announces itself instead of waiting for its first refresh, and
+        # asks its neighbors for the topology instead of waiting for their refreshes
+        self.originate_lsm()
+        for neighbor in self.neighbors:
+            self.sync_with(neighbor)
+        selector = selectors.DefaultSelector()
+        selector.register(self.sock, selectors.EVENT_READ)
         while 1:
-            try:
-                packet, _ = self.sock.recvfrom(8092)
-                msg = pickle.loads(packet)
-                self.emulate_once(msg)
-            except:
-                pass
-
-            # Send Hello to neighbors
-            if time.time() - self.last_hello_sent >= self.hello_interval:
-                self.last_hello_sent = time.time()
-                self.broadcast_to_neighbors(Message(
-                    source=self.address,
-                    packet_type='HELLO'
-                ))
-            # Send LSM to neighbors
-            if time.time() - self.last_LSM_sent >= self.lsm_interval:
-                # print("adj_list: ", self.adj_list)
-                # print("forwarding: ", self.forwarding_table)
-                self.last_LSM_sent = time.time()
-                self.broadcast_to_neighbors(Message(
-                    source=self.address,
-                    packet_type='LSM',
-                    seq_num=self.sequence_no + 1,
-                    ttl=self.ttl,
-                    neighbors=self.adj_list[self.address]
-                ))
-                self.sequence_no += 1
-            # Check if any neighbor is dead
-            result = self.neighbor_list.check_timeout()
-            if result:
-                # Send new link state message and rebuild forwarding_table
-                logging.info("Broadcasting dead neighbor to other nodes")
-                if result[0] in self.adj_list[self.address]:
-                    self.adj_list[self.address].remove(result[0])
-                if self.address in self.adj_list[result[0]]:
-                    self.adj_list[result[0]].remove(self.address)
-                self.broadcast_to_neighbors(
-                    Message(
-                        source=self.address,
-                        packet_type='LSM',
-                        seq_num=self.sequence_no + 1,
-                        ttl=self.ttl,  # maximum of 20 nodes, put 25 just to be safe
-                        neighbors=self.adj_list[self.address]
-                    )
-                )
-                self.sequence_no += 1
-                self.build_forwarding_table(result[0])
+            # sleep until a packet arrives or the next timer is due
+            if selector.select(max(self.next_timer() - time.monotonic(), 0)):
+                self.receive_packets()
+            self.run_timers()
 
+    def receive_packets(self) -> None:
+        """Handles every datagram waiting on the socket."""
+        while 1:
+            try:
+                packet, sender = self.sock.recvfrom(8092)
+            except BlockingIOError:
+                return
+            try:
+                msg = Message.from_bytes(packet)
+            except ValueError as e:
+                logging.debug(f"Ignored a packet from {sender}: {e}")
+                continue
+            try:
+                self.emulate_once(msg, sender)
+            except Exception:
+                logging.exception(f"Failed to handle a {msg.packet_type} packet from {sender}")
+
+    def next_timer(self) -> float:
+        """The time.monotonic() at which run_timers has something to do."""
+        timers = [self.next_hello, self.next_LSM_refresh, self.next_age_check, self.next_stats]
+        if self.neighbor_list.next_expiry() is not None:
+            timers.append(self.neighbor_list.next_expiry())
+        if self.spf_throttle.due is not None:
+            timers.append(self.spf_throttle.due)
+        if self.dampening.next_reuse() is not None:
+            timers.append(self.dampening.next_reuse())
+        return min(timers)
+
+    def neighbor_up(self, node: Address) -> None:
+        """Adds the link to a neighbor that came up and announces it."""
+        added = [e for e in [(self.address, node), (node, self.address)]
+                 if e[1] not in self.adj_list[e[0]]]
+        self.adj_list[self.address].add(node)
+        self.adj_list[node].add(self.address)
+        self.sequence_tracking[node] = 0
+        # hearing from it directly is as good as a fresh LSM until its own arrives
+        self.lsm_heard[node] = time.monotonic()
+        if added:
+            self.schedule_spf(added=added)
+            self.originate_lsm()
+        self.sync_with(node)
+
+    def neighbors_down(self, dead: List[Address]) -> None:
+        """Removes the links to neighbors that timed out and announces it once."""
+        announce = False
+        for node in dead:
+            self.dampening.flap(node, time.monotonic())
+            removed = []
+            if node in self.adj_list[self.address]:
+                self.adj_list[self.address].remove(node)
+                removed.append((self.address, node))
+            if self.address in self.adj_list[node]:
+                self.adj_list[node].remove(self.address)
+                removed.append((node, self.address))
+            # a suppressed neighbor was never announced, so there is nothing to take back
+            if removed:
+                self.schedule_spf(removed, dead_node=node)
+                announce = True
+        if announce:
+            logging.info("Broadcasting dead neighbors to other nodes")
+            self.originate_lsm()
+
+    def run_timers(self) -> None:
+        now = time.monotonic()
+        # Send Hello to neighbors
+        if now >= self.next_hello:
+            self.next_hello = now + self.hello_interval * random.uniform(0.75, 1)
+            # every neighbor of the topology file, dead or suppressed ones too, so that
+            # both ends of a link that went down notice when it comes back
+            for neighbor in self.neighbors:
+                self.sock.sendto(self.hello, neighbor)
+            self.control_stats["hello_sent"] += len(self.neighbors)
+        # Refresh our LSM so that other nodes don't age it out
+        if now >= self.next_LSM_refresh:
+            self.originate_lsm()
+        if now >= self.next_stats:
+            self.next_stats = now + STATS_INTERVAL
+            self.log_stats()
+        if now >= self.next_age_check:
+            self.next_age_check = now + 1
+            self.age_lsdb()
+        # Check if any neighbor is dead
+        dead = self.neighbor_list.check_timeout()
+        if dead:
+            self.neighbors_down(dead)
+        # Announce suppressed neighbors that have been stable for long enough
+        for node in self.dampening.release(now):
+            if node in self.neighbor_list.last_seen:
+                logging.info(f"Neighbor {node} is no longer suppressed")
+                self.control_stats["flap_reused"] += 1
+                self.neighbor_up(node)
+        # changes are applied here, off the receive path, once per hold-down window
+        if self.spf_throttle.ready(time.monotonic()):
+            self.run_spf()
 
 
 if __name__ == "__main__":
@@ -326,6 +860,25 @@ if __name__ == "__main__":
     parser.add_argument(
         "-f", help="the topology file", type=str, required=True
     )
+    parser.add_argument("--spf-initial", help="seconds to wait for more changes before the first SPF run",
+                        type=float, default=0.05)
+    parser.add_argument("--spf-hold", help="seconds between SPF runs while changes keep coming, doubled up to --spf-max",
+                        type=float, default=0.2)
+    parser.add_argument("--spf-max", help="longest wait between SPF runs in seconds", type=float, default=2.0)
+    parser.add_argument("--lsm-refresh", help="seconds between LSMs when nothing changes", type=float, default=30)
+    parser.add_argument("--hello-interval", help="seconds between HELLOs, down to a few hundredths",
+                        type=float, default=1.5)
+    parser.add_argument("--detect-multiplier", help="HELLO intervals without a HELLO before a neighbor is dead",
+                        type=float, default=2.5)
+    parser.add_argument("--up-count", help="HELLOs in a row before a dead neighbor is up again",
+                        type=int, default=1)
+    parser.add_argument("--dampening", help="flap dampening: penalty half-life in seconds, suppress and reuse "
+                        "thresholds, with 1000 points per flap", nargs=3, type=float,
+                        metavar=("HALF_LIFE", "SUPPRESS", "REUSE"), default=[15, 2000, 750])
+    parser.add_argument("--max-suppress", help="longest time a flapping neighbor stays suppressed in seconds",
+                        type=float, default=60)
 
     arg = parser.parse_args()
-    e = Emulator(arg.p, arg.f)
+    e = Emulator(arg.p, arg.f, arg.spf_initial, arg.spf_hold, arg.spf_max, arg.lsm_refresh,
+                 arg.hello_interval, arg.detect_multiplier, arg.up_count,
+                 FlapDampening(*arg.dampening, max_suppress=arg.max_suppress))
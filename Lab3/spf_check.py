@@ -0,0 +1,112 @@
+import argparse
+import contextlib
+import io
+import random
+from typing import Dict, List, Set
+
+from emulator import Address, Edge, Emulator, ShortestPathTree, first_hop_tree
+
+
+def random_changes(rng: random.Random, nodes: List[Address], adj: Dict[Address, Set[Address]],
+                   count: int) -> List[Edge]:
+    """Picks `count` distinct directed edges to flip, mostly ones next to existing edges."""
+    edges: Set[Edge] = set()
+    while len(edges) < count:
+        u = rng.choice(nodes)
+        if adj[u] and rng.random() < 0.5:
+            edges.add((u, rng.choice(sorted(adj[u]))))
+        else:
+            v = rng.choice(nodes)
+            if v != u:
+                edges.add((u, v))
+    return list(edges)
+
+
+def check(seed: int, nodes: int, degree: float, rounds: int, batch: int) -> None:
+    rng = random.Random(seed)
+    names = [(f"10.0.{i // 256}.{i % 256}", 5000 + i) for i in range(nodes)]
+    adj: Dict[Address, Set[Address]] = {n: set() for n in names}
+    for _ in range(int(nodes * degree / 2)):
+        u, v = rng.sample(names, 2)
+        adj[u].add(v)
+        adj[v].add(u)
+    root = names[0]
+    spf = ShortestPathTree(root, adj)
+
+    for r in range(rounds):
+        old = {(u, v) for u in adj for v in adj[u]}
+        for u, v in random_changes(rng, names, adj, rng.randint(1, batch)):
+            # links usually fail and come back in both directions, LSMs carry one side at a time
+            pairs = [(u, v), (v, u)] if rng.random() < 0.5 else [(u, v)]
+            for a, b in pairs:
+                adj[a].symmetric_difference_update({b})
+        new = {(u, v) for u in adj for v in adj[u]}
+        removed, added = list(old - new), list(new - old)
+        before = dict(spf.first_hops)
+        changed = spf.update(removed, added)
+        dist, first_hops = first_hop_tree(root, adj)
+        assert spf.dist == dist, f"seed {seed} round {r}: distances differ"
+        assert spf.first_hops == first_hops, f"seed {seed} round {r}: first hops differ"
+        expected = {n for n in set(before) | set(first_hops) if before.get(n) != first_hops.get(n)}
+        assert changed == expected, f"seed {seed} round {r}: reported changes differ"
+
+
+def check_table(seed: int, nodes: int, degree: float, rounds: int) -> None:
+    """Drives Emulator.build_forwarding_table the way timeouts and LSMs do, against a full recompute."""
+    rng = random.Random(seed)
+    names = [(f"10.0.{i // 256}.{i % 256}", 5000 + i) for i in range(nodes)]
+    adj: Dict[Address, Set[Address]] = {n: set() for n in names}
+    for _ in range(int(nodes * degree / 2)):
+        u, v = rng.sample(names, 2)
+        adj[u].add(v)
+        adj[v].add(u)
+    root = names[0]
+    # only the state build_forwarding_table touches; no sockets
+    emu = object.__new__(Emulator)
+    emu.address, emu.adj_list, emu.offline_repr = root, adj, ('125.125.125.125', -1)
+    emu.all_nodes_except_self, emu.forwarding_table = names[1:], {}
+    emu.spf = ShortestPathTree(root, adj)
+    with contextlib.redirect_stdout(io.StringIO()):
+        emu.build_forwarding_table()
+        for r in range(rounds):
+            if adj[root] and rng.random() < 0.4:
+                # a neighbor times out: both directions of the link go, the node is declared dead
+                dead = rng.choice(sorted(adj[root]))
+                adj[root].discard(dead)
+                adj[dead].discard(root)
+                emu.build_forwarding_table([dead], [(root, dead), (dead, root)])
+            elif rng.random() < 0.3:
+                # a neighbor comes back
+                back = rng.choice(names[1:])
+                added = [(a, b) for a, b in ((root, back), (back, root)) if b not in adj[a]]
+                for a, b in added:
+                    adj[a].add(b)
+                emu.build_forwarding_table((), (), added)
+            else:
+                # an LSM from elsewhere that does not touch this node
+                u, v = rng.sample(names[1:], 2)
+                edge = (u, v)
+                if v in adj[u]:
+                    adj[u].discard(v)
+                    emu.build_forwarding_table((), [edge])
+                else:
+                    adj[u].add(v)
+                    emu.build_forwarding_table((), (), [edge])
+            _, first_hops = first_hop_tree(root, adj)
+            expected = {n: first_hops.get(n, emu.offline_repr) for n in names[1:]}
+            assert emu.forwarding_table == expected, f"seed {seed} round {r}: forwarding table differs"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare incremental SPF updates with a full recompute on random topologies")
+    parser.add_argument("--seeds", help="number of random topologies", type=int, default=200)
+    parser.add_argument("--nodes", type=int, default=30)
+    parser.add_argument("--degree", help="average number of neighbors", type=float, default=3)
+    parser.add_argument("--rounds", help="edge change batches per topology", type=int, default=50)
+    parser.add_argument("--batch", help="largest number of edges changed at once", type=int, default=4)
+    args = parser.parse_args()
+
+    for seed in range(args.seeds):
+        check(seed, args.nodes, args.degree, args.rounds, args.batch)
+        check_table(seed, args.nodes, args.degree, args.rounds)
+    print(f"{args.seeds} topologies x {args.rounds} changes: incremental SPF and forwarding table match a full recompute")
@@ -1,5 +1,4 @@
 import socket
-import pickle
 import argparse
 from emulator import Message
 import time
@@ -9,7 +8,8 @@ class trace:
         self.port = port
         self.srcName = srcName
         self.srcPort = srcPort
-        self.destName = destName
+        # messages carry IPv4 addresses, and replies are matched against this one
+        self.destName = socket.gethostbyname(destName)
         self.destPort = destPort
         self.debugOption = debugOption
         
@@ -36,7 +36,7 @@ class trace:
             except:
                 continue
             self.sock.settimeout(None)
-            response = pickle.loads(response)
+            response = Message.from_bytes(response)
             assert type(response) == Message
             assert response.packet_type == 'TRACE'
             if self.debugOption: